@@ -0,0 +1,41 @@
+"""本番用のgunicornの設定
+
+アプリケーションをフォーク前に読み込み(preload_app)、warmupコマンドでテンプレートのコンパイルと
+主要なページのキャッシュを作ってからワーカーを起動する。ワーカーはこれらをコピーオンライトで共有するので、
+最初のリクエストから安定した応答時間で応答できる。
+"""
+
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+workers = int(os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", "1"))
+preload_app = True
+# 起動時に処理するQuestionの詳細ページの数(POLLS_WARMUP=0で起動時の準備を行わない)
+warmup_questions = int(os.environ.get("POLLS_WARMUP_QUESTIONS", "10"))
+
+
+def when_ready(server):
+    """ワーカーを起動する前に、読み込んだアプリケーションを使って準備する"""
+
+    if os.environ.get("POLLS_WARMUP", "1") != "1":
+        return
+    from django.core.management import call_command
+
+    from polls.metrics import registry
+
+    try:
+        call_command("warmup", questions=warmup_questions)
+    except Exception:
+        server.log.exception("Warm-up failed")
+    # 準備のリクエストをワーカーのメトリクスに含めない
+    registry.reset()
+
+
+def pre_fork(server, worker):
+    """データベースの接続を子プロセスに引き継がないよう、フォーク前に閉じる"""
+
+    from django.db import connections
+
+    connections.close_all()
@@ -50,6 +50,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "polls.metrics.MetricsMiddleware",
+    "polls.ratelimit.VoteLimitMiddleware",
+    "polls.routers.ReplicaPinMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
@@ -93,6 +96,9 @@ DATABASES = {
     }
 }
 
+# 読み込みをPOLLS_READ_REPLICASのレプリカに振り分ける(未設定ならdefaultだけを使う)
+DATABASE_ROUTERS = ["polls.routers.PrimaryReplicaRouter"]
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -1,7 +1,43 @@
+from django.core.exceptions import ImproperlyConfigured
+
 from .base import *
 
 DEBUG = False
 
+# テンプレートは最初の読み込み時にコンパイルしてプロセス内に残す
+# (gunicorn.conf.pyではフォーク前にwarmupコマンドでまとめてコンパイルし、ワーカーで共有する)
+TEMPLATES[0]["APP_DIRS"] = False
+TEMPLATES[0]["OPTIONS"]["loaders"] = [
+    (
+        "django.template.loaders.cached.Loader",
+        [
+            "django.template.loaders.filesystem.Loader",
+            "django.template.loaders.app_directories.Loader",
+        ],
+    ),
+]
+
+# 集計結果・ページ・重複投票のフィルター・レート制限などのキャッシュは全てのワーカーで共有し、
+# addとincrが不可分に動く必要があるので、本番ではRedisを必須にする
+# (既定のLocMemCacheはプロセスごと、ファイルのキャッシュはincrが読み込みと書き込みに分かれ、
+# 件数が上限を超えると投票の増分などを無作為に消す)
+if not os.environ.get("REDIS_URL"):
+    message = "Set REDIS_URL to a Redis server shared by all workers (e.g. redis://redis:6379/0)."
+    raise ImproperlyConfigured(message)
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.environ["REDIS_URL"],
+    }
+}
+
+# SQLiteのまま同時アクセスに耐えるモード(環境変数POLLS_SQLITE_WAL=1で有効にする)
+# WALと接続ごとのプラグマ、永続的な接続、書き込みの直列化を使う
+if os.environ.get("POLLS_SQLITE_WAL") == "1":
+    POLLS_SQLITE_WAL = True
+    DATABASES["default"]["CONN_MAX_AGE"] = int(os.environ.get("CONN_MAX_AGE", "600"))
+    DATABASES["default"]["CONN_HEALTH_CHECKS"] = True
+
 try:
     from .local import *
 except ImportError:
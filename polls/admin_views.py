@@ -0,0 +1,21 @@
+from django.core.exceptions import PermissionDenied  # type: ignore
+from django.http import Http404, StreamingHttpResponse  # type: ignore
+from django.shortcuts import get_object_or_404  # type: ignore
+
+from .exports import EXPORT_FORMATS, iter_results_rows
+from .models import Polls
+
+
+def export_results(request, page_id):
+    """Pollsページ以下の全てのQuestionの投票結果をストリーミングでダウンロードさせる"""
+
+    polls = get_object_or_404(Polls, pk=page_id)
+    if not polls.permissions_for_user(request.user).can_edit():
+        raise PermissionDenied
+    fmt = request.GET.get("format", "csv")
+    if fmt not in EXPORT_FORMATS:
+        raise Http404
+    stream, content_type = EXPORT_FORMATS[fmt]
+    response = StreamingHttpResponse(stream(iter_results_rows(polls)), content_type=content_type)
+    response["Content-Disposition"] = f'attachment; filename="polls-{polls.pk}-results.{fmt}"'
+    return response
@@ -0,0 +1,177 @@
+import gc
+import statistics
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from django.contrib.contenttypes.models import ContentType  # type: ignore
+from django.db import connection, transaction  # type: ignore
+from django.test import Client  # type: ignore
+from django.test.utils import CaptureQueriesContext  # type: ignore
+from django.utils import timezone  # type: ignore
+from wagtail.models import Page  # type: ignore
+
+from home.models import HomePage
+
+from .indexing import reindex_questions
+from .models import Author, Choice, Polls, Question
+
+SEED_BATCH_SIZE = 2000
+SCENARIOS = ["index", "detail", "results", "vote", "search"]
+METRICS = ["p50_ms", "p99_ms", "queries", "peak_kb"]
+# 基準値を超えたら失敗にする項目と許容する増加の割合
+GATED_TOLERANCES = {"queries": 0, "peak_kb": 0.2}
+# レイテンシは計測するマシンと負荷に左右されるので、既定では超えても警告だけにする
+LATENCY_TOLERANCE = 0.5
+
+
+def seed_questions(size: int, choices: int = 5, authors: int = 3) -> Polls:
+    """Pollsページの下にsize件の公開済みQuestionを、選択肢と作成者付きでまとめて作成する
+
+    1件ずつadd_childすると木構造の更新やシグナルで時間がかかるので、木構造のパスを計算して一括で挿入し、
+    最後に検索の索引をまとめて登録する。
+    """
+
+    home = HomePage.objects.get(depth=2)
+    polls = home.add_child(instance=Polls(title=f"Bench {size}", slug=f"bench-{size}"))
+    content_type = ContentType.objects.get_for_model(Question)
+    author_objs = Author.objects.bulk_create([Author(name=f"Author {size}-{i}") for i in range(authors)])
+    now = timezone.now()
+
+    with transaction.atomic():
+        for start in range(0, size, SEED_BATCH_SIZE):
+            pages = Page.objects.bulk_create(
+                [
+                    Page(
+                        path=Page._get_path(polls.path, polls.depth + 1, number + 1),
+                        depth=polls.depth + 1,
+                        numchild=0,
+                        title=f"Question {size}-{number}",
+                        draft_title=f"Question {size}-{number}",
+                        slug=f"question-{number}",
+                        url_path=f"{polls.url_path}question-{number}/",
+                        content_type=content_type,
+                        locale_id=polls.locale_id,
+                        live=True,
+                        first_published_at=now,
+                        last_published_at=now,
+                    )
+                    for number in range(start, min(start + SEED_BATCH_SIZE, size))
+                ]
+            )
+            # Questionはマルチテーブル継承なのでbulk_createできない。作成済みのPageの子テーブルの行だけを、
+            # フィクスチャの読み込みと同じraw保存で挿入する(フィールドの既定値はモデルから取る)
+            for page in pages:
+                Question(page_ptr=page, pub_date=now.date()).save_base(raw=True, force_insert=True)
+            Choice.objects.bulk_create(
+                [
+                    Choice(question_id=page.pk, sort_order=i, choice_text=f"Choice {page.title} {i}")
+                    for page in pages
+                    for i in range(choices)
+                ]
+            )
+            Question.authors.through.objects.bulk_create(
+                [
+                    Question.authors.through(question_id=page.pk, author_id=author_objs[i % authors].pk)
+                    for i, page in enumerate(pages)
+                ]
+            )
+        Page.objects.filter(pk=polls.pk).update(numchild=size)
+
+    reindex_questions(Question.objects.child_of(polls).values_list("pk", flat=True))
+    return polls
+
+
+def get_scenarios(polls: Polls) -> Dict[str, Callable]:
+    """計測するビューのリクエストを行う関数の辞書"""
+
+    questions = Question.objects.child_of(polls).order_by("path")
+    question = questions[questions.count() // 2]
+    choice = question.choices.first()
+    question_url = question.get_url()
+    client = Client()
+    return {
+        "index": lambda: client.get(polls.get_url()),
+        "detail": lambda: client.get(question_url),
+        "results": lambda: client.get(question_url + "results/"),
+        "vote": lambda: client.post(question_url + "vote/", {"choice": choice.pk}),
+        "search": lambda: client.get("/search/", {"query": question.title}),
+    }
+
+
+def percentile(values: List[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))]
+
+
+def measure(request: Callable, iterations: int = 50, warmup: int = 3, memory_samples: int = 5) -> Dict[str, float]:
+    """1つのビューのレイテンシの中央値と99パーセンタイル、クエリ数とメモリ使用量のピークを計測する
+
+    tracemallocは処理を遅くするので、レイテンシとは別にmemory_samples回計測する。
+    キャッシュの追い出しやガベージコレクションなどで1回だけ大きくなる値で失敗しないよう、ピークは最小値を使う。
+    """
+
+    for _ in range(warmup):
+        response = request()
+        if response.status_code >= 400:  # noqa: PLR2004
+            raise AssertionError(f"Unexpected status code {response.status_code}")
+
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        request()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    with CaptureQueriesContext(connection) as queries:
+        request()
+    query_count = len(queries)
+
+    peaks = []
+    for _ in range(memory_samples):
+        tracemalloc.start()
+        try:
+            request()
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        peaks.append(peak)
+    peak = min(peaks)
+
+    return {
+        "p50_ms": round(statistics.median(timings), 2),
+        "p99_ms": round(percentile(timings, 99), 2),
+        "queries": query_count,
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def run_benchmarks(size: int, choices: int = 5, iterations: int = 50) -> Dict[str, Dict[str, float]]:
+    polls = seed_questions(size, choices=choices)
+    # 作成したデータのオブジェクトの回収が最初のシナリオの計測中に起きないよう、先に回収しておく
+    gc.collect()
+    return {name: measure(request, iterations) for name, request in get_scenarios(polls).items()}
+
+
+def compare(results: dict, baseline: dict, tolerances: Optional[Dict[str, float]] = None) -> List[str]:
+    """tolerancesに含めた項目について、基準値から許容する割合を超えて増えた項目のメッセージのリストを返す
+
+    既定ではマシンに左右されないクエリ数(1つでも増えたら超過)とメモリ使用量のピークだけを比べる。
+    """
+
+    if tolerances is None:
+        tolerances = GATED_TOLERANCES
+    regressions = []
+    for size, scenarios in results.items():
+        for name, metrics in scenarios.items():
+            expected = baseline.get(size, {}).get(name)
+            if expected is None:
+                continue
+            for metric in METRICS:
+                if metric not in expected or metric not in tolerances:
+                    continue
+                limit = expected[metric] * (1 + tolerances[metric])
+                if metrics[metric] > limit:
+                    regressions.append(
+                        f"{size} questions / {name}: {metric} {metrics[metric]} exceeds baseline {expected[metric]}"
+                    )
+    return regressions
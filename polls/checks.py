@@ -0,0 +1,58 @@
+from django.conf import settings  # type: ignore
+from django.core import checks  # type: ignore
+
+# addとincrを不可分に行うキャッシュのバックエンド
+ATOMIC_CACHE_BACKENDS = {
+    "django.core.cache.backends.redis.RedisCache",
+    "django.core.cache.backends.memcached.PyMemcacheCache",
+    "django.core.cache.backends.memcached.PyLibMCCache",
+    "django.core.cache.backends.locmem.LocMemCache",
+}
+# 複数のプロセスで共有できるもの
+SHARED_CACHE_BACKENDS = ATOMIC_CACHE_BACKENDS - {"django.core.cache.backends.locmem.LocMemCache"}
+
+
+def get_cache_backend() -> str:
+    return settings.CACHES["default"]["BACKEND"]
+
+
+def is_atomic_cache() -> bool:
+    """既定のキャッシュのaddとincrが不可分かどうか"""
+
+    return get_cache_backend() in ATOMIC_CACHE_BACKENDS
+
+
+@checks.register(checks.Tags.caches)
+def check_vote_cache(app_configs, **kwargs):
+    """重複投票のフィルターとレート制限が使う既定のキャッシュが、addとincrを不可分に行うか確認する
+
+    重複投票の防止は管理画面からQuestionごとにいつでも有効にできるので、設定にかかわらず確認する。
+    """
+
+    backend = get_cache_backend()
+    if backend in ATOMIC_CACHE_BACKENDS:
+        return []
+    return [
+        checks.Error(
+            f"{backend} does not increment atomically, "
+            "so buffered votes, the vote guard and rate limits would lose updates.",
+            hint="Use RedisCache or a Memcached backend for CACHES['default'].",
+            id="polls.E001",
+        )
+    ]
+
+
+@checks.register(checks.Tags.caches, deploy=True)
+def check_shared_cache(app_configs, **kwargs):
+    """本番(check --deploy)で、既定のキャッシュが全てのワーカーで共有されているか確認する"""
+
+    backend = get_cache_backend()
+    if backend not in ATOMIC_CACHE_BACKENDS or backend in SHARED_CACHE_BACKENDS:
+        return []
+    return [
+        checks.Warning(
+            f"{backend} is not shared between processes, so each worker keeps its own tallies, filters and limits.",
+            hint="Use RedisCache or a Memcached backend for CACHES['default'] in production.",
+            id="polls.W001",
+        )
+    ]
@@ -0,0 +1,90 @@
+import contextlib
+import os
+import threading
+
+from django.conf import settings  # type: ignore
+from django.db import connections  # type: ignore
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# 接続ごとに設定するプラグマ(WALでは読み込みが書き込みを待たない)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "temp_store": "MEMORY",
+}
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+
+def is_sqlite_wal_enabled(using: str = "default") -> bool:
+    """POLLS_SQLITE_WALが有効で、接続先がSQLiteかどうか"""
+
+    return getattr(settings, "POLLS_SQLITE_WAL", False) and connections[using].vendor == "sqlite"
+
+
+def configure_sqlite_connection(sender, connection, **kwargs):
+    """connection_createdシグナルでSQLiteの接続にWALなどのプラグマを設定する"""
+
+    if connection.vendor != "sqlite" or not getattr(settings, "POLLS_SQLITE_WAL", False):
+        return
+    busy_timeout = getattr(settings, "POLLS_SQLITE_BUSY_TIMEOUT_MS", SQLITE_BUSY_TIMEOUT_MS)
+    with connection.cursor() as cursor:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.execute(f"PRAGMA busy_timeout={int(busy_timeout)}")
+
+
+class SerializedWriter:
+    """書き込みをプロセス内のスレッド間とプロセス間(ファイルロック)で1つずつ行わせる
+
+    SQLiteでは書き込みのロックを取り合うと「database is locked」になるので、
+    投票や検索のヒット数などの書き込みはこのロックを取ってから行う。同じスレッド内では入れ子にできる。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._file = None
+        self._pid = None
+
+    def get_lock_path(self, using: str = "default") -> str:
+        return f"{connections[using].settings_dict['NAME']}.write-lock"
+
+    @contextlib.contextmanager
+    def __call__(self, using: str = "default"):
+        if not is_sqlite_wal_enabled(using):
+            yield
+            return
+        with self._lock:
+            depth = getattr(self._local, "depth", 0)
+            if depth == 0:
+                self._lock_file(using)
+            self._local.depth = depth + 1
+            try:
+                yield
+            finally:
+                self._local.depth = depth
+                if depth == 0:
+                    self._unlock_file()
+
+    def _lock_file(self, using):
+        if fcntl is None or connections[using].is_in_memory_db():
+            return
+        path = self.get_lock_path(using)
+        # fork後の子プロセスでは親と同じファイル記述を共有しないよう開き直す
+        if self._file is None or self._file.name != path or self._pid != os.getpid():
+            if self._file is not None:
+                self._file.close()
+            self._file = open(path, "a+b")  # noqa: SIM115
+            self._pid = os.getpid()
+        fcntl.flock(self._file, fcntl.LOCK_EX)
+
+    def _unlock_file(self):
+        if fcntl is not None and self._file is not None and self._pid == os.getpid():
+            fcntl.flock(self._file, fcntl.LOCK_UN)
+
+
+serialized_write = SerializedWriter()
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async  # type: ignore
+from django.conf import settings  # type: ignore
+
+from .tallies import get_cached_tally, get_tally, get_tally_version
+
+
+class TallyBroker:
+    """Questionごとの購読者に集計結果の更新を知らせるプロセス内のpub/sub
+
+    通知はasyncio.Eventを立てるだけなので、購読者が処理する前に何票入っても1回の更新にまとまる。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers = defaultdict(set)
+
+    def subscribe(self, question_id: int) -> asyncio.Event:
+        event = asyncio.Event()
+        with self._lock:
+            self._subscribers[question_id].add((asyncio.get_running_loop(), event))
+        return event
+
+    def unsubscribe(self, question_id: int, event: asyncio.Event):
+        with self._lock:
+            subscribers = self._subscribers[question_id]
+            subscribers.difference_update({item for item in subscribers if item[1] is event})
+            if not subscribers:
+                del self._subscribers[question_id]
+
+    def publish(self, question_ids):
+        """投票を処理したスレッドから呼ばれるので、各イベントループに処理を渡してEventを立てる"""
+
+        with self._lock:
+            targets = [item for question_id in question_ids for item in self._subscribers.get(question_id, ())]
+        for loop, event in targets:
+            try:
+                loop.call_soon_threadsafe(event.set)
+            except RuntimeError:  # イベントループが既に閉じている
+                pass
+
+
+broker = TallyBroker()
+
+
+def get_retry_ms() -> int:
+    """接続が切れた後、EventSourceが再接続するまでのミリ秒"""
+
+    return getattr(settings, "POLLS_SSE_RETRY_MS", 3000)
+
+
+def format_tally_event(tally: dict, version: int) -> str:
+    return f"id: {version}\nevent: tally\ndata: {json.dumps(tally)}\n\n"
+
+
+async def stream_tally(question_id: int, last_event_id=None):
+    """集計結果が変わるたびにServer-Sent Eventsの文字列を返す非同期ジェネレーター
+
+    他のプロセスで入った票はこのプロセスに通知されないため、POLLS_SSE_POLL_INTERVAL秒ごとに
+    キャッシュのバージョンも確認する。キャッシュの読み込みは同期のビューが使うスレッドを待たせないよう
+    別のスレッドで行い(thread_sensitive=False)、キャッシュに無い集計結果を作る場合だけ同期のスレッドを使う。
+    """
+
+    min_interval = getattr(settings, "POLLS_SSE_MIN_INTERVAL", 0.5)
+    poll_interval = getattr(settings, "POLLS_SSE_POLL_INTERVAL", 5)
+    max_duration = getattr(settings, "POLLS_SSE_MAX_DURATION", 300)
+    deadline = time.monotonic() + max_duration
+    version = last_event_id
+    event = broker.subscribe(question_id)
+    try:
+        while time.monotonic() < deadline:
+            # 読み込み中に届いた通知を取りこぼさないよう、先にEventを下ろしてから確認する
+            event.clear()
+            current = await sync_to_async(get_tally_version, thread_sensitive=False)(question_id)
+            if str(current) != str(version):
+                version = current
+                tally = await sync_to_async(get_cached_tally, thread_sensitive=False)(question_id)
+                if tally is None:
+                    tally = await sync_to_async(get_tally)(question_id)
+                yield format_tally_event(tally, version)
+                # 短い間隔で届いた票をまとめて次の1回で送る
+                await asyncio.sleep(min_interval)
+                continue
+            try:
+                await asyncio.wait_for(event.wait(), timeout=poll_interval)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+        # 接続を一度閉じ、クライアントに再接続してもらう
+        yield f"retry: {get_retry_ms()}\n\n"
+    finally:
+        broker.unsubscribe(question_id, event)
@@ -0,0 +1,48 @@
+import csv
+import json
+
+from .models import Choice
+from .votes import annotate_vote_totals
+
+EXPORT_FIELDS = ["question_id", "question_title", "pub_date", "choice_id", "choice_text", "votes"]
+
+
+class Echo:
+    """csv.writerの出力をそのまま返すだけのファイル風オブジェクト"""
+
+    def write(self, value):
+        return value
+
+
+def iter_results_rows(polls, chunk_size=2000):
+    """Pollsページ以下の全てのQuestionの結果を1つのChoiceにつき1行ずつ返す
+
+    1つのクエリをiterator()で少しずつ読み込むので、Questionが多くても全件をメモリに載せない。
+    """
+
+    choices = annotate_vote_totals(
+        Choice.objects.filter(question__path__startswith=polls.path, question__depth=polls.depth + 1)
+    )
+    return (
+        choices.order_by("question_id", "sort_order")
+        .values_list("question_id", "question__title", "question__pub_date", "pk", "choice_text", "total_votes")
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def stream_jsonl(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(EXPORT_FIELDS, row)), default=str, ensure_ascii=False) + "\n"
+
+
+EXPORT_FORMATS = {
+    "csv": (stream_csv, "text/csv"),
+    "jsonl": (stream_jsonl, "application/x-ndjson"),
+}
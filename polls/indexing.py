@@ -0,0 +1,40 @@
+from typing import Iterable, Optional
+
+from wagtail.search.backends import get_search_backends  # type: ignore
+
+from .models import Question
+
+REINDEX_CHUNK_SIZE = 500
+
+
+def reindex_questions(
+    question_ids: Optional[Iterable[int]] = None,
+    chunk_size: int = REINDEX_CHUNK_SIZE,
+    with_auto_update: bool = True,
+) -> int:
+    """Questionを主キーの順にchunk_size件ずつ取得し、選択肢と作成者と一緒に検索バックエンドへまとめて登録する
+
+    question_idsを省略すると全てのQuestionを登録する。OFFSETではなく前回の最後の主キーから
+    続きを取得するので、件数が多くても後半のチャンクが遅くならない。登録した件数を返す。
+    """
+
+    backends = list(get_search_backends(with_auto_update=with_auto_update))
+    if not backends:
+        return 0
+    queryset = Question.get_indexed_objects()
+    if question_ids is not None:
+        queryset = queryset.filter(pk__in=list(question_ids))
+
+    indexed = 0
+    last_pk = 0
+    while True:
+        chunk = list(queryset.filter(pk__gt=last_pk).order_by("pk")[:chunk_size])
+        if not chunk:
+            return indexed
+        for backend in backends:
+            backend.add_bulk(Question, chunk)
+        indexed += len(chunk)
+        if len(chunk) < chunk_size:
+            return indexed
+        last_pk = chunk[-1].pk
+
@@ -0,0 +1,104 @@
+import json
+import os
+
+from django.conf import settings  # type: ignore
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.db import connection  # type: ignore
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment  # type: ignore
+
+from polls.benchmarks import LATENCY_TOLERANCE, compare, run_benchmarks
+from search.hits import hit_buffer
+
+DEFAULT_BASELINE = os.path.join(settings.BASE_DIR, "benchmarks", "baseline.json")
+
+
+class Command(BaseCommand):
+    help = (
+        "生成したデータで主要なビュー(一覧・詳細・投票・結果・検索)のレイテンシ(p50/p99)、クエリ数、"
+        "メモリ使用量のピークを計測し、クエリ数とメモリ使用量が基準値を超えたら失敗する(レイテンシは警告のみ)。"
+        "テスト用のデータベースを作成して実行する"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000], help="Questionの件数(複数指定可)")
+        parser.add_argument("--choices", type=int, default=5, help="Questionごとの選択肢の数")
+        parser.add_argument("--iterations", type=int, default=50, help="ビューごとのリクエスト回数")
+        parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基準値のJSONファイル")
+        parser.add_argument("--update-baseline", action="store_true", help="計測結果で基準値を書き換える")
+        parser.add_argument(
+            "--latency-tolerance", type=float, default=LATENCY_TOLERANCE, help="レイテンシの許容する増加の割合"
+        )
+        parser.add_argument(
+            "--gate-latency",
+            action="store_true",
+            help="レイテンシが基準値を超えた場合も失敗にする(基準値と同じマシンで使う)",
+        )
+        parser.add_argument("--memory-tolerance", type=float, default=0.2, help="メモリ使用量の許容する増加の割合")
+        parser.add_argument("--output", help="計測結果を書き出すJSONファイル")
+
+    def handle(self, *args, **options):
+        results = {}
+        setup_test_environment()
+        try:
+            for size in options["sizes"]:
+                self.stderr.write(f"Benchmarking {size} questions...")
+                results[str(size)] = self.run_size(size, options)
+        finally:
+            teardown_test_environment()
+
+        for size, scenarios in results.items():
+            for name, metrics in scenarios.items():
+                values = ", ".join(f"{metric}={value}" for metric, value in metrics.items())
+                self.stdout.write(f"{size:>7} {name:<8} {values}")
+        if options["output"]:
+            self.write_json(options["output"], results)
+
+        if options["update_baseline"]:
+            baseline = self.read_baseline(options["baseline"])
+            baseline.update(results)
+            self.write_json(options["baseline"], baseline)
+            self.stdout.write(self.style.SUCCESS(f"Baseline written to {options['baseline']}."))
+            return
+
+        baseline = self.read_baseline(options["baseline"])
+        gated = {"queries": 0, "peak_kb": options["memory_tolerance"]}
+        latency = {"p50_ms": options["latency_tolerance"], "p99_ms": options["latency_tolerance"]}
+        if options["gate_latency"]:
+            gated.update(latency)
+        else:
+            for message in compare(results, baseline, latency):
+                self.stderr.write(self.style.WARNING(f"Latency (advisory): {message}"))
+        regressions = compare(results, baseline, gated)
+        if regressions:
+            raise CommandError("Benchmark regressions:\n" + "\n".join(regressions))
+        self.stdout.write(self.style.SUCCESS("No regressions against the baseline."))
+
+    def run_size(self, size, options):
+        """データの件数ごとに空のテスト用データベースを作り直して計測する"""
+
+        old_name = connection.settings_dict["NAME"]
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # 計測結果が設定の既定値に左右されないよう、キャッシュはプロセス内のものを使う
+            with override_settings(
+                CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                DEBUG=False,
+            ):
+                results = run_benchmarks(size, choices=options["choices"], iterations=options["iterations"])
+                # 溜まっている検索のヒット数は、テスト用のデータベースを破棄する前に書き込んでおく
+                hit_buffer.flush()
+                return results
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    def read_baseline(self, path):
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+
+    def write_json(self, path, data):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write("\n")
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+
+from polls.exports import EXPORT_FORMATS, iter_results_rows
+from polls.models import Polls
+
+
+class Command(BaseCommand):
+    help = "Pollsページ以下の全てのQuestionの投票結果をCSVまたはJSONLで標準出力に書き出す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("polls_id", type=int, nargs="?", help="Pollsページのid。省略した場合は全てのPollsページ")
+        parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="1回に読み込む行数")
+
+    def handle(self, *args, **options):
+        polls_pages = Polls.objects.order_by("path")
+        if options["polls_id"] is not None:
+            polls_pages = polls_pages.filter(pk=options["polls_id"])
+            if not polls_pages.exists():
+                raise CommandError(f"Polls page {options['polls_id']} does not exist.")
+
+        stream, _ = EXPORT_FORMATS[options["format"]]
+        for i, polls in enumerate(polls_pages):
+            lines = stream(iter_results_rows(polls, chunk_size=options["chunk_size"]))
+            if i and options["format"] == "csv":
+                next(lines)  # 2つ目以降のPollsページではヘッダーを書かない
+            for line in lines:
+                self.stdout.write(line, ending="")
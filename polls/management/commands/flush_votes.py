@@ -0,0 +1,43 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.db import close_old_connections  # type: ignore
+
+from polls.models import Choice
+from polls.votes import flush_vote_deltas
+
+
+class Command(BaseCommand):
+    help = "キャッシュに溜まっている投票数の増分をデータベースに書き込む(write-behindモード用)"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="1回に確認するChoiceの数")
+        parser.add_argument(
+            "--interval", type=float, default=0, help="指定秒数ごとに繰り返すワーカーとして動かす(0は1回だけ)"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            total = self.flush_all(options["chunk_size"])
+            if total or not options["interval"]:
+                self.stdout.write(self.style.SUCCESS(f"{total} votes flushed."))
+            if not options["interval"]:
+                return
+            close_old_connections()
+            time.sleep(options["interval"])
+
+    def flush_all(self, chunk_size):
+        total = 0
+        chunk = []
+        for choice_id in Choice.objects.order_by("pk").values_list("pk", flat=True).iterator(chunk_size=chunk_size):
+            chunk.append(choice_id)
+            if len(chunk) >= chunk_size:
+                total += self.flush(chunk)
+                chunk = []
+        return total + self.flush(chunk)
+
+    def flush(self, choice_ids):
+        flushed = flush_vote_deltas(choice_ids)
+        if flushed < 0:
+            raise CommandError("Another process is flushing votes. Try again later.")
+        return flushed
@@ -0,0 +1,87 @@
+import csv
+import json
+import sys
+
+from django.core.management.base import BaseCommand, CommandError  # type: ignore
+from django.db import transaction  # type: ignore
+
+from polls.db import serialized_write
+from polls.models import Choice
+from polls.votes import apply_question_deltas, apply_vote_deltas, send_votes_changed
+
+
+class Command(BaseCommand):
+    help = (
+        "CSVまたはJSONLの投票データを少しずつ読み込み、Choiceごとに集計してまとめて加算する。"
+        "各行はchoice_idと省略可能なvotes(既定は1)を持つ"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="読み込むファイル。-を指定すると標準入力から読み込む")
+        parser.add_argument("--format", choices=["csv", "jsonl"], help="省略した場合はファイルの拡張子から判断する")
+        parser.add_argument("--batch-size", type=int, default=5000, help="1回のトランザクションで加算するChoiceの数")
+        parser.add_argument("--progress-every", type=int, default=100000, help="進捗を表示する行数の間隔")
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"] or ("jsonl" if path.endswith((".jsonl", ".ndjson")) else "csv")
+        if path == "-" and not options["format"]:
+            raise CommandError("--format is required when reading from stdin.")
+        self.batch_size = options["batch_size"]
+        self.progress_every = options["progress_every"]
+        self.rows = self.skipped = self.applied = self.missing = 0
+
+        if path == "-":
+            self.import_rows(self.read(sys.stdin, fmt))
+        else:
+            with open(path, encoding="utf-8", newline="") as f:
+                self.import_rows(self.read(f, fmt))
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{self.rows} rows read, {self.applied} votes imported, "
+                f"{self.skipped} invalid rows skipped, {self.missing} unknown choices skipped."
+            )
+        )
+
+    def read(self, f, fmt):
+        """1行ずつ(choice_id, votes)を返す。不正な行はNoneを返す"""
+
+        records = csv.DictReader(f) if fmt == "csv" else (line for line in f if line.strip())
+        for record in records:
+            try:
+                if fmt == "jsonl":
+                    record = json.loads(record)  # noqa: PLW2901
+                votes = record.get("votes")
+                yield int(record["choice_id"]), 1 if votes in (None, "") else int(votes)
+            except (KeyError, TypeError, ValueError, AttributeError):
+                yield None
+
+    def import_rows(self, rows):
+        deltas = {}
+        for row in rows:
+            self.rows += 1
+            if row is None:
+                self.skipped += 1
+            else:
+                choice_id, votes = row
+                deltas[choice_id] = deltas.get(choice_id, 0) + votes
+                # 集計中のChoiceの数が上限に達したら書き込み、メモリの使用量を一定に保つ
+                if len(deltas) >= self.batch_size:
+                    self.apply(deltas)
+                    deltas = {}
+            if self.progress_every and self.rows % self.progress_every == 0:
+                self.stderr.write(f"{self.rows} rows read, {self.applied} votes imported...")
+        self.apply(deltas)
+
+    def apply(self, deltas):
+        if not deltas:
+            return
+        with serialized_write(), transaction.atomic():
+            existing = set(Choice.objects.filter(pk__in=list(deltas)).values_list("pk", flat=True))
+            existing_deltas = {choice_id: votes for choice_id, votes in deltas.items() if choice_id in existing}
+            apply_vote_deltas(existing_deltas)
+            question_ids = apply_question_deltas(existing_deltas)
+        send_votes_changed(question_ids)
+        self.missing += len(deltas) - len(existing)
+        self.applied += sum(votes for choice_id, votes in deltas.items() if choice_id in existing)
@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand  # type: ignore
+from django.db import close_old_connections  # type: ignore
+
+from polls.scheduling import publish_due_questions
+
+
+class Command(BaseCommand):
+    help = "公開日(pub_date)を迎えた予約済みのQuestionをまとめて公開し、一覧・詳細・結果ページのキャッシュを作る"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=None, help="1回に公開するQuestionの最大数")
+        parser.add_argument("--no-warm", action="store_false", dest="warm", help="公開後にキャッシュを作らない")
+        parser.add_argument(
+            "--interval", type=float, default=0, help="指定秒数ごとに繰り返すワーカーとして動かす(0は1回だけ)"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            questions = publish_due_questions(limit=options["limit"], warm=options["warm"])
+            if questions or not options["interval"]:
+                self.stdout.write(self.style.SUCCESS(f"{len(questions)} scheduled questions published."))
+            if not options["interval"]:
+                return
+            close_old_connections()
+            time.sleep(options["interval"])
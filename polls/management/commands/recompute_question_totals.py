@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand  # type: ignore
+from django.utils import timezone  # type: ignore
+
+from polls.votes import recompute_question_totals
+
+
+class Command(BaseCommand):
+    help = "QuestionのChoiceとシャードから、非正規化したtotal_votesとleading_choiceを計算し直す"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--chunk-size", type=int, default=1000, help="1回のUPDATEで更新するQuestionの数")
+        parser.add_argument(
+            "--since-minutes",
+            type=float,
+            default=None,
+            help="指定した分数以内にシャードへの投票があったQuestionだけを計算し直す(shardedで定期的に実行する場合)",
+        )
+
+    def handle(self, *args, **options):
+        since = None
+        if options["since_minutes"] is not None:
+            since = timezone.now() - timezone.timedelta(minutes=options["since_minutes"])
+        updated = recompute_question_totals(chunk_size=options["chunk_size"], since=since)
+        self.stdout.write(self.style.SUCCESS(f"{updated} questions recomputed."))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand  # type: ignore
+
+from polls.votes import rollup_vote_events
+
+
+class Command(BaseCommand):
+    help = "投票ログ(VoteEvent)を前回の集計位置から順にChoice.votesへ集計する"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=10000, help="1回のトランザクションで集計するイベント数")
+        parser.add_argument("--lag", type=float, default=5, help="作成から指定秒数が経過したイベントのみ集計する")
+
+    def handle(self, *args, **options):
+        total = rollup_vote_events(batch_size=options["batch_size"], lag=options["lag"])
+        self.stdout.write(self.style.SUCCESS(f"{total} vote events rolled up."))
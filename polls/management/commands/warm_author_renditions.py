@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand  # type: ignore
+from django.db.models import Prefetch  # type: ignore
+from wagtail.images import get_image_model  # type: ignore
+
+from polls.models import AUTHOR_IMAGE_FILTER, Author
+from polls.renditions import warm_author_rendition
+
+
+class Command(BaseCommand):
+    help = "全ての作成者の画像について、詳細ページで使うレンディションをまとめて作成する"
+
+    def handle(self, *args, **options):
+        renditions = get_image_model().get_rendition_model().objects.filter(filter_spec=AUTHOR_IMAGE_FILTER)
+        authors = (
+            Author.objects.filter(author_image__isnull=False)
+            .select_related("author_image")
+            .prefetch_related(Prefetch("author_image__renditions", queryset=renditions, to_attr="prefetched_renditions"))
+        )
+        created = sum(warm_author_rendition(author) for author in authors)
+        self.stdout.write(self.style.SUCCESS(f"{created} renditions created."))
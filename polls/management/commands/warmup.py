@@ -0,0 +1,22 @@
+import time
+
+from django.core.management.base import BaseCommand  # type: ignore
+
+from polls.warming import warm_up
+
+
+class Command(BaseCommand):
+    help = "モデルとURLの設定の読み込み、テンプレートのコンパイル、サイトのルートと主要なページのキャッシュの作成を行う"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--questions", type=int, default=10, help="詳細ページを処理する最近公開したQuestionの数")
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        result = warm_up(questions=options["questions"])
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"{result['models']} models, {result['templates']} templates and {result['urls']} pages warmed "
+                f"({result['failed_urls']} pages failed) in {time.perf_counter() - start:.2f}s."
+            )
+        )
@@ -0,0 +1,282 @@
+import atexit
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction  # type: ignore
+from django.conf import settings  # type: ignore
+
+logger = logging.getLogger(__name__)
+
+# レイテンシのヒストグラムのバケット(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS_FILE_PATTERN = "metrics-{}.json"
+
+# 処理中のリクエストのクエリ数と時間を集める[件数, 秒数]
+_request_queries: contextvars.ContextVar = contextvars.ContextVar("polls_request_queries", default=None)
+
+
+def get_metrics_dir() -> Optional[str]:
+    """ワーカー間で集計結果を共有するディレクトリ。未設定ならプロセス内の集計だけを公開する"""
+
+    return getattr(settings, "POLLS_METRICS_DIR", None)
+
+
+def _new_route():
+    return {
+        "count": 0,
+        "sum": 0.0,
+        "buckets": [0] * len(LATENCY_BUCKETS),
+        "queries": 0,
+        "query_seconds": 0.0,
+        "statuses": defaultdict(int),
+    }
+
+
+class MetricsRegistry:
+    """プロセス内でリクエストの集計を行い、一定間隔でプロセスごとのファイルに書き出す
+
+    リクエストごとにはカウンターを加算するだけにして、出力の形式への変換は/metricsの表示時に行う。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._routes = defaultdict(_new_route)
+            self._cache = defaultdict(lambda: {"hit": 0, "miss": 0})
+            self._last_write = time.monotonic()
+
+    def observe_request(self, route: str, status: int, seconds: float, queries: int, query_seconds: float):
+        with self._lock:
+            stats = self._routes[route]
+            stats["count"] += 1
+            stats["sum"] += seconds
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    stats["buckets"][i] += 1
+                    break
+            stats["queries"] += queries
+            stats["query_seconds"] += query_seconds
+            stats["statuses"][str(status)] += 1
+        self.write_if_due()
+
+    def observe_cache(self, name: str, hit: bool):
+        with self._lock:
+            self._cache[name]["hit" if hit else "miss"] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "routes": {
+                    route: {**stats, "buckets": list(stats["buckets"]), "statuses": dict(stats["statuses"])}
+                    for route, stats in self._routes.items()
+                },
+                "cache": {name: dict(counts) for name, counts in self._cache.items()},
+            }
+
+    def get_path(self) -> Optional[str]:
+        directory = get_metrics_dir()
+        return os.path.join(directory, METRICS_FILE_PATTERN.format(os.getpid())) if directory else None
+
+    def write_if_due(self):
+        interval = getattr(settings, "POLLS_METRICS_WRITE_INTERVAL", 10)
+        if get_metrics_dir() and time.monotonic() - self._last_write >= interval:
+            self.write()
+
+    def write(self):
+        """このプロセスの集計結果をファイルに書き出す(書き込み途中のファイルを読まれないよう置き換える)"""
+
+        path = self.get_path()
+        if path is None:
+            return
+        self._last_write = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Failed to write metrics to %s", path)
+
+    def collect(self) -> dict:
+        """全てのワーカーの集計結果を合計する(このプロセスの分は最新の値を使う)"""
+
+        snapshots = [self.snapshot()]
+        own_path = self.get_path()
+        directory = get_metrics_dir()
+        if directory:
+            for path in glob.glob(os.path.join(directory, METRICS_FILE_PATTERN.format("*"))):
+                if path == own_path:
+                    continue
+                try:
+                    with open(path, encoding="utf-8") as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue
+        return merge_snapshots(snapshots)
+
+
+def merge_snapshots(snapshots: Iterable[dict]) -> dict:
+    routes: Dict[str, dict] = defaultdict(_new_route)
+    cache: Dict[str, dict] = defaultdict(lambda: {"hit": 0, "miss": 0})
+    for snapshot in snapshots:
+        for route, stats in snapshot.get("routes", {}).items():
+            merged = routes[route]
+            for key in ("count", "sum", "queries", "query_seconds"):
+                merged[key] += stats[key]
+            merged["buckets"] = [a + b for a, b in zip(merged["buckets"], stats["buckets"])]
+            for status, count in stats["statuses"].items():
+                merged["statuses"][status] += count
+        for name, counts in snapshot.get("cache", {}).items():
+            cache[name]["hit"] += counts["hit"]
+            cache[name]["miss"] += counts["miss"]
+    return {"routes": routes, "cache": cache}
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def render_prometheus(data: dict) -> str:
+    """集計結果をPrometheusのテキスト形式にする"""
+
+    routes = sorted(data["routes"].items())
+    lines: List[str] = [
+        "# HELP polls_http_request_duration_seconds Request latency by route.",
+        "# TYPE polls_http_request_duration_seconds histogram",
+    ]
+    for route, stats in routes:
+        label = f'route="{_escape(route)}"'
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, stats["buckets"]):
+            cumulative += count
+            lines.append(f'polls_http_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+        lines.append(f'polls_http_request_duration_seconds_bucket{{{label},le="+Inf"}} {stats["count"]}')
+        lines.append(f"polls_http_request_duration_seconds_sum{{{label}}} {stats['sum']}")
+        lines.append(f"polls_http_request_duration_seconds_count{{{label}}} {stats['count']}")
+
+    lines += [
+        "# HELP polls_http_responses_total Responses by route and status code.",
+        "# TYPE polls_http_responses_total counter",
+    ]
+    for route, stats in routes:
+        for status, count in sorted(stats["statuses"].items()):
+            lines.append(f'polls_http_responses_total{{route="{_escape(route)}",status="{status}"}} {count}')
+
+    lines += [
+        "# HELP polls_db_queries_total Database queries by route.",
+        "# TYPE polls_db_queries_total counter",
+    ]
+    lines += [f'polls_db_queries_total{{route="{_escape(route)}"}} {stats["queries"]}' for route, stats in routes]
+    lines += [
+        "# HELP polls_db_query_duration_seconds_total Time spent in database queries by route.",
+        "# TYPE polls_db_query_duration_seconds_total counter",
+    ]
+    lines += [
+        f'polls_db_query_duration_seconds_total{{route="{_escape(route)}"}} {stats["query_seconds"]}'
+        for route, stats in routes
+    ]
+
+    lines += [
+        "# HELP polls_cache_requests_total Cache lookups by cache and result.",
+        "# TYPE polls_cache_requests_total counter",
+    ]
+    for name, counts in sorted(data["cache"].items()):
+        for result in ("hit", "miss"):
+            lines.append(f'polls_cache_requests_total{{cache="{_escape(name)}",result="{result}"}} {counts[result]}')
+    return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+atexit.register(registry.write)
+
+
+def record_cache(name: str, hit: bool):
+    """キャッシュのヒットとミスを記録する"""
+
+    registry.observe_cache(name, hit)
+
+
+def query_timer(execute, sql, params, many, context):
+    """データベース接続に登録し、処理中のリクエストのクエリ数と時間を数える"""
+
+    counter = _request_queries.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        counter[0] += 1
+        counter[1] += time.perf_counter() - start
+
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_createdシグナルで接続ごとにquery_timerを登録する"""
+
+    if query_timer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(query_timer)
+
+
+def get_route(request) -> str:
+    """集計に使うルート名。Wagtailのページはbefore_serve_pageフックで設定したページの種類とサブページの名前"""
+
+    route = getattr(request, "metrics_route", None)
+    if route:
+        return route
+    match = getattr(request, "resolver_match", None)
+    if match is not None:
+        return match.view_name or match._func_path
+    return "unmatched"
+
+
+class MetricsMiddleware:
+    """ルートごとのレイテンシとクエリ数を集計するミドルウェア(同期・非同期どちらのビューにも対応)"""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = [0, 0.0]
+        token = _request_queries.set(counter)
+        start = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.observe(request, response, time.perf_counter() - start, counter)
+        return response
+
+    async def __acall__(self, request):
+        counter = [0, 0.0]
+        token = _request_queries.set(counter)
+        start = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.observe(request, response, time.perf_counter() - start, counter)
+        return response
+
+    def observe(self, request, response, seconds, counter):
+        route = get_route(request)
+        if route == "metrics":
+            return
+        registry.observe_request(route, response.status_code, seconds, counter[0], counter[1])
@@ -0,0 +1,50 @@
+# Generated by Django 4.2.30 on 2026-10-17 13:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_vote_totals(apps, schema_editor):
+    """既存のQuestionのtotal_votesとleading_choiceをChoiceとシャードから計算する"""
+
+    Question = apps.get_model("polls", "Question")
+    Choice = apps.get_model("polls", "Choice")
+    ChoiceVoteShard = apps.get_model("polls", "ChoiceVoteShard")
+    shard_votes = dict(
+        ChoiceVoteShard.objects.values("choice_id").annotate(sum=models.Sum("votes")).values_list("choice_id", "sum")
+    )
+    totals = {}
+    for choice in Choice.objects.order_by("question_id", "sort_order", "pk").iterator():
+        votes = choice.votes + shard_votes.get(choice.pk, 0)
+        total, leader, leader_votes = totals.get(choice.question_id, (0, None, -1))
+        if votes > leader_votes:
+            leader, leader_votes = choice.pk, votes
+        totals[choice.question_id] = (total + votes, leader, leader_votes)
+    for question_id, (total, leader, _) in totals.items():
+        Question.objects.filter(pk=question_id).update(total_votes=total, leading_choice_id=leader)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0004_vote_event_log'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='question',
+            name='last_vote_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='leading_choice',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='polls.choice'),
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='total_votes',
+            field=models.IntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(populate_vote_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.30 on 2026-10-17 13:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0005_question_vote_totals'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='choice',
+            index=models.Index(fields=['question', 'sort_order'], name='polls_choice_question_sort'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.30 on 2026-10-17 13:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0006_choice_question_sort_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VoteGuardFilter',
+            fields=[
+                ('question', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='+', serialize=False, to='polls.question')),
+                ('num_blocks', models.PositiveIntegerField()),
+                ('hashes', models.PositiveSmallIntegerField()),
+                ('bits', models.BinaryField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='question',
+            name='prevent_duplicate_votes',
+            field=models.BooleanField(default=False, help_text='同じ投票者(セッションまたはIPアドレス)からの2回目以降の投票を受け付けない'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-17 13:59
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('polls', '0007_vote_guard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='choicevoteshard',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,19 +1,51 @@
+from datetime import datetime, time
 from typing import ClassVar, List
 
 from django import forms  # type: ignore
-from django.db import models  # type: ignore
-from django.http import HttpResponseRedirect  # type: ignore
+from django.conf import settings  # type: ignore
+from django.core.handlers.asgi import ASGIRequest  # type: ignore
+from django.db import DEFAULT_DB_ALIAS, models, transaction  # type: ignore
+from django.db.models import Exists, OuterRef, Prefetch, Sum  # type: ignore
+from django.db.models.functions import Coalesce  # type: ignore
+from django.http import HttpResponse, HttpResponseRedirect, JsonResponse, StreamingHttpResponse  # type: ignore
+from django.urls import reverse  # type: ignore
 from django.utils import timezone  # type: ignore
+from django.utils.cache import get_conditional_response, patch_cache_control  # type: ignore
 from modelcluster.fields import ParentalKey, ParentalManyToManyField  # type: ignore
 from wagtail.admin.forms import WagtailAdminPageForm  # type: ignore
 from wagtail.admin.panels import FieldPanel, InlinePanel, MultiFieldPanel  # type: ignore
 from wagtail.contrib.routable_page.models import RoutablePageMixin, path  # type: ignore
 from wagtail.fields import RichTextField  # type: ignore
+from wagtail.images import get_image_model  # type: ignore
 from wagtail.models import Orderable, Page  # type: ignore
+from wagtail.search import index  # type: ignore
 from wagtail.snippets.models import register_snippet  # type: ignore
 
+from .db import serialized_write
+from .events import format_tally_event, get_retry_ms, stream_tally
+from .page_cache import PageCacheMixin, never_page_cache
+from .tallies import get_tally, get_tally_version
+from .vote_guard import is_duplicate_vote
+from .votes import record_vote
 
-class Polls(Page):
+# detail.htmlで作成者の画像に使っているフィルター(テンプレートの{% image %}と合わせる)
+AUTHOR_IMAGE_FILTER = "fill-40x60"
+
+
+# リビジョンに含めても、公開時には現在の値を残すQuestionのフィールド
+VOTE_TOTAL_FIELDS = ["total_votes", "leading_choice_id", "last_vote_at"]
+
+DUPLICATE_VOTE_MESSAGE = "You have already voted in this poll."
+
+# Pollsページの一覧の並び順(?sort=)。票数と最後の投票日時はQuestionに非正規化した値で並べる
+QUESTION_SORTS = {
+    "newest": ["-id"],
+    "popular": ["-total_votes", "-id"],
+    "active": [models.F("last_vote_at").desc(nulls_last=True), "-id"],
+}
+
+
+class Polls(PageCacheMixin, Page):
     """pollsアプリのトップページ"""
 
     intro = RichTextField(blank=True)
@@ -29,22 +61,33 @@ class Polls(Page):
     # 独自のテンプレートファイルの設定
     template = "polls/index.html"
 
+    def get_questions(self):
+        """子ページのQuestion
+
+        child_ofのpath__startswithはSQLiteではLIKEになり索引を使えないので、
+        子ページのパスが取り得る範囲で絞り込んでpathの索引を使う。
+        """
+
+        last_step = Page.alphabet[-1] * Page.steplen
+        return Question.objects.filter(depth=self.depth + 1, path__gt=self.path, path__lte=self.path + last_step)
+
     def get_context(self, request):
         """本日から過去の要素とchoice_textの要素が存在するか絞り込む"""
 
         context = super().get_context(request)
 
+        # 汎用のPageではなくQuestionを直接取得して、テンプレートで1件ごとにspecificを呼ばないようにする
+        questions = self.get_questions().live()
+        sort = request.GET.get("sort")
+        ordering = QUESTION_SORTS.get(sort, QUESTION_SORTS["newest"])
         if request.user.is_authenticated:
-            pollspages = self.get_children().live().order_by("-id")
+            pollspages = questions.order_by(*ordering)
         else:
-            pollspages = (
-                self.get_children()
-                .live()
-                .filter(question__pub_date__lte=timezone.now(), question__choices__choice_text__isnull=False)
-                .distinct()
-                .order_by("-id")[:5]
-            )
+            # 選択肢との結合とdistinctの代わりにEXISTSで絞り込む
+            has_choice = Exists(Choice.objects.filter(question=OuterRef("pk"), choice_text__isnull=False))
+            pollspages = questions.filter(has_choice, pub_date__lte=timezone.now()).order_by(*ordering)[:5]
         context["pollspages"] = pollspages
+        context["sort"] = sort if sort in QUESTION_SORTS else "newest"
         return context
 
 
@@ -52,19 +95,33 @@ class QuestionForm(WagtailAdminPageForm):
     """Questionモデルの管理ページカスタマイズ"""
 
     def clean(self):
-        """フォームに入力されたデータの検査"""
+        """フォームに入力されたデータの検査
+
+        未来の日付で公開しようとした場合は、その日の0時を公開日時(go_live_at)にして公開を予約する。
+        予約したQuestionはpublish_due_questionsコマンドが公開してキャッシュを作る。
+        """
         cleaned_data = super().clean()
         if "pub_date" in cleaned_data:
             date = cleaned_data["pub_date"]
-            # 未来の日付且つ公開として保存しようとした場合にエラーを発生させる
             if date > timezone.now().date() and "action-publish" in self.data:
-                self.add_error("pub_date", "未来の日付で保存する場合は非公開にする必要があります!!")
+                go_live_at = timezone.make_aware(datetime.combine(date, time.min))
+                if not cleaned_data.get("go_live_at") or cleaned_data["go_live_at"] < go_live_at:
+                    cleaned_data["go_live_at"] = go_live_at
         return cleaned_data
 
 
-class Question(RoutablePageMixin, Page):
+class Question(PageCacheMixin, RoutablePageMixin, Page):
     pub_date = models.DateField("Post date", blank=False)
     authors = ParentalManyToManyField("polls.Author", blank=True)
+    # 投票のたびに更新する非正規化した集計値(recompute_question_totalsコマンドで作り直せる)
+    total_votes = models.IntegerField(default=0, editable=False)
+    leading_choice = models.ForeignKey(
+        "polls.Choice", null=True, blank=True, on_delete=models.SET_NULL, related_name="+", editable=False
+    )
+    last_vote_at = models.DateTimeField(null=True, blank=True, editable=False)
+    prevent_duplicate_votes = models.BooleanField(
+        default=False, help_text="同じ投票者(セッションまたはIPアドレス)からの2回目以降の投票を受け付けない"
+    )
     content_panels: ClassVar[List[str]] = [
         *Page.content_panels,
         # 日付と作成者をグループ化して読みやすくする
@@ -78,11 +135,99 @@ class Question(RoutablePageMixin, Page):
         FieldPanel("pub_date"),
         InlinePanel("choices", label="Choices", min_num=2),
     ]
+    settings_panels: ClassVar[List[str]] = [*Page.settings_panels, FieldPanel("prevent_duplicate_votes")]
+    # 集計値はコピー元のChoiceを数えたものなので、コピーしたページには引き継がずにcopyで作り直す
+    exclude_fields_in_copy: ClassVar[List[str]] = ["total_votes", "leading_choice", "last_vote_at"]
+    # 選択肢のテキストと作成者名でも検索できるようにする
+    search_fields: ClassVar[List[index.BaseField]] = [
+        *Page.search_fields,
+        index.RelatedFields("choices", [index.SearchField("choice_text")]),
+        index.RelatedFields("authors", [index.SearchField("name")]),
+    ]
+    # 下書きの保存ごとには索引を更新せず、公開時にpolls.indexingでまとめて更新する
+    search_auto_update = False
     parent_page_types: ClassVar[List[str]] = ["polls.Polls"]
     template = "polls/detail.html"
     # カスタムフォームの設定
     base_form_class = QuestionForm
 
+    def with_content_json(self, content):
+        """リビジョンから復元する際に、リビジョンの作成後に変わった票数と集計値を現在の値のまま残す
+
+        公開で保存する時にはsaveがロックを取って読み直すので、ここで読んだ値はプレビューなどの表示用になる。
+        """
+
+        obj = super().with_content_json(content)
+        for field in VOTE_TOTAL_FIELDS:
+            setattr(obj, field, getattr(self, field))
+        obj.refresh_vote_counts()
+        return obj
+
+    def refresh_vote_counts(self, *, lock: bool = False):
+        """プライマリから現在のChoice.votesと集計値を読み込んで、保存していない子のChoiceと自身に設定する
+
+        lockがTrueの場合は、投票と同じくChoice、Questionの順に行をロックする(トランザクション内で使う)。
+        """
+
+        choices = Choice.objects.using(DEFAULT_DB_ALIAS).filter(question_id=self.pk)
+        questions = Question.objects.using(DEFAULT_DB_ALIAS).filter(pk=self.pk)
+        if lock:
+            choices = choices.select_for_update()
+            questions = questions.select_for_update()
+        votes = dict(choices.values_list("pk", "votes"))
+        for choice in self.choices.all():
+            if choice.pk in votes:
+                choice.votes = votes[choice.pk]
+        totals = questions.values(*VOTE_TOTAL_FIELDS).first()
+        for field, value in (totals or {}).items():
+            setattr(self, field, value)
+
+    def save(self, *args, **kwargs):
+        """保存(リビジョンの公開を含む)の直前に、その間の投票で変わった票数と集計値を読み直してから書き込む
+
+        リビジョンから復元したChoice.votesを絶対値のまま書き込むと、復元してから保存するまでの投票が失われるので、
+        同じトランザクション内で行をロックして読み直す。
+        """
+
+        if self.pk is None:
+            return super().save(*args, **kwargs)
+        with serialized_write(), transaction.atomic(using=DEFAULT_DB_ALIAS):
+            self.refresh_vote_counts(lock=True)
+            return super().save(*args, **kwargs)
+
+    def copy(self, *args, **kwargs):
+        """ページをコピーし、集計値(total_votesとleading_choice)をコピーしたChoiceから作り直す"""
+
+        page_copy = super().copy(*args, **kwargs)
+        choices = Choice.objects.filter(question_id=page_copy.pk)
+        page_copy.total_votes = choices.aggregate(total=Coalesce(Sum("votes"), 0))["total"]
+        page_copy.leading_choice = choices.order_by("-votes", "sort_order", "pk").first()
+        Question.objects.filter(pk=page_copy.pk).update(
+            total_votes=page_copy.total_votes, leading_choice=page_copy.leading_choice
+        )
+        return page_copy
+
+    @classmethod
+    def get_indexed_objects(cls):
+        """索引に登録するQuestion。ParentalManyToManyFieldはRelatedFieldsでprefetchされないので明示する"""
+
+        return super().get_indexed_objects().prefetch_related("authors")
+
+    def get_context(self, request, *args, **kwargs):
+        """投票の送信先と、作成者と画像、表示に使うレンディションをまとめて取得する"""
+
+        context = super().get_context(request, *args, **kwargs)
+        # ASGIで動かす場合は非同期の投票ビューにフォームを送信する
+        if getattr(settings, "POLLS_ASYNC_VOTE", False):
+            context["vote_url"] = reverse("polls:vote", args=[self.pk])
+        else:
+            context["vote_url"] = self.get_url(request) + self.reverse_subpage("vote")
+        renditions = get_image_model().get_rendition_model().objects.filter(filter_spec=AUTHOR_IMAGE_FILTER)
+        context["authors"] = self.authors.select_related("author_image").prefetch_related(
+            Prefetch("author_image__renditions", queryset=renditions, to_attr="prefetched_renditions")
+        )
+        return context
+
     # URLパターンの追加
     @path("vote/")
     def vote(self, request):
@@ -99,9 +244,17 @@ class Question(RoutablePageMixin, Page):
                 context_overrides=context,
             )
 
-        # votesフィールドに整数1を加算して保存
-        selected_choice.votes += 1
-        selected_choice.save()
+        if is_duplicate_vote(self, request):
+            response = self.render(
+                request,
+                "polls/detail.html",
+                context_overrides={"error_message": DUPLICATE_VOTE_MESSAGE},
+            )
+            response.status_code = 409
+            return response
+
+        # 設定された書き込み方式(POLLS_VOTE_MODE)で1票を記録する
+        record_vote(selected_choice, request)
         # 「/polls/slug/results/」を生成して変数に格納
         url = self.url + self.reverse_subpage("results")
         return HttpResponseRedirect(url)
@@ -113,8 +266,45 @@ class Question(RoutablePageMixin, Page):
         return self.render(
             request,
             template="polls/results.html",
+            context_overrides={"tally": get_tally(self.pk)},
         )
 
+    @path("results/json/")
+    @never_page_cache
+    def results_json(self, request):
+        """投票結果のJSON。集計結果が変わっていなければ304を返す"""
+
+        etag = f'"{self.pk}-{get_tally_version(self.pk)}"'
+        response = get_conditional_response(request, etag=etag)
+        if response is None:
+            response = JsonResponse(get_tally(self.pk))
+        response["ETag"] = etag
+        patch_cache_control(response, no_cache=True)
+        return response
+
+    @path("results/stream/")
+    @never_page_cache
+    def results_stream(self, request):
+        """投票結果をServer-Sent Eventsで配信する
+
+        ASGIでは接続を保ったまま票が入るたびに送信する。WSGIではワーカーを占有しないよう
+        現在の結果を1回だけ送り、EventSourceの再接続に任せる。
+        """
+
+        last_event_id = request.headers.get("Last-Event-ID")
+        if isinstance(request, ASGIRequest):
+            response = StreamingHttpResponse(stream_tally(self.pk, last_event_id), content_type="text/event-stream")
+        else:
+            version = get_tally_version(self.pk)
+            content = f"retry: {get_retry_ms()}\n\n"
+            if str(version) != last_event_id:
+                content += format_tally_event(get_tally(self.pk), version)
+            response = HttpResponse(content, content_type="text/event-stream")
+        patch_cache_control(response, no_cache=True)
+        # nginxなどのリバースプロキシでバッファリングさせない
+        response["X-Accel-Buffering"] = "no"
+        return response
+
     class Meta:
         # 作成するページのタイプを選択する際の表示名を定義
         verbose_name = "Choice text"
@@ -134,6 +324,66 @@ class Choice(Orderable):
         FieldPanel("votes"),
     ]
 
+    class Meta(Orderable.Meta):
+        # Choiceは常にQuestionごとにsort_orderの順で読み込むので、並べ替えずに読める索引を作る
+        indexes: ClassVar[List[models.Index]] = [
+            models.Index(fields=["question", "sort_order"], name="polls_choice_question_sort"),
+        ]
+
+
+class ChoiceVoteShard(models.Model):
+    """Choiceの投票数を分割して持つカウンター
+
+    人気のChoiceに投票が集中しても同じ行をロックし合わないように、投票ごとにランダムなシャードへ加算する。
+    Choiceの投票数はChoice.votesと全シャードの合計になる。
+    """
+
+    choice = models.ForeignKey(Choice, on_delete=models.CASCADE, related_name="vote_shards")
+    shard = models.PositiveSmallIntegerField()
+    votes = models.IntegerField(default=0)
+    # 最後に加算した日時(recompute_question_totalsでQuestion.last_vote_atに反映する)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        constraints: ClassVar[List[models.UniqueConstraint]] = [
+            models.UniqueConstraint(fields=["choice", "shard"], name="polls_choicevoteshard_unique_shard"),
+        ]
+
+
+class VoteEvent(models.Model):
+    """1票ごとに追記するだけの投票ログ
+
+    rollup_votesコマンドで定期的にChoice.votesへ集計する。
+    追記を軽くするため、choiceには索引も外部キー制約も作らない(集計は主キーの範囲で行う)。
+    Choiceを削除してもログは監査用に残す。
+    """
+
+    choice = models.ForeignKey(
+        Choice, on_delete=models.DO_NOTHING, related_name="+", db_index=False, db_constraint=False
+    )
+    created_at = models.DateTimeField(default=timezone.now)
+    voter_hash = models.CharField(max_length=64, blank=True)
+
+
+class VoteGuardFilter(models.Model):
+    """重複投票の防止に使うQuestionごとのBloomフィルターの保存先
+
+    普段はキャッシュ上のフィルターで確認し、一定の投票者数ごとにここへ保存する。
+    """
+
+    question = models.OneToOneField(Question, on_delete=models.CASCADE, primary_key=True, related_name="+")
+    num_blocks = models.PositiveIntegerField()
+    hashes = models.PositiveSmallIntegerField()
+    bits = models.BinaryField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class VoteRollup(models.Model):
+    """VoteEventをどこまでChoice.votesに集計したかを記録する(1行のみ)"""
+
+    last_event_id = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
 
 # Wagtailデコレーター
 @register_snippet
@@ -0,0 +1,101 @@
+import hashlib
+import re
+import time
+
+from django.conf import settings  # type: ignore
+from django.core.cache import cache  # type: ignore
+from django.http import HttpResponse  # type: ignore
+from django.middleware.csrf import get_token  # type: ignore
+from wagtail.models import Site  # type: ignore
+
+from .metrics import record_cache
+
+PAGE_CACHE_KEY = "polls:page:{site_id}:{page_id}:{version}:{path}"
+PAGE_VERSION_KEY = "polls:page-version:{}"
+# キャッシュしたHTMLではCSRFトークンをこの文字列に置き換え、配信時にリクエストごとのトークンに戻す
+CSRF_PLACEHOLDER = "__polls_csrf_token__"
+CSRF_INPUT_RE = re.compile(r'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+
+
+def get_page_cache_timeout() -> int:
+    """ページ全体をキャッシュする秒数。0(既定)ならキャッシュしない"""
+
+    return getattr(settings, "POLLS_PAGE_CACHE_TIMEOUT", 0)
+
+
+def get_page_version(page_id: int) -> int:
+    key = PAGE_VERSION_KEY.format(page_id)
+    version = cache.get(key)
+    if version is None:
+        # キーが追い出された後に古いバージョンを再利用しないよう、時刻から始める
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def purge_page_cache(page_ids):
+    """ページのバージョンを上げて、キャッシュしたHTMLを全て参照されないようにする"""
+
+    for page_id in set(page_ids):
+        try:
+            cache.incr(PAGE_VERSION_KEY.format(page_id))
+        except ValueError:
+            get_page_version(page_id)
+
+
+def is_cacheable_request(request) -> bool:
+    """匿名ユーザーのクエリ文字列無しのGETのみキャッシュする"""
+
+    return (
+        request.method == "GET"
+        and not request.GET
+        and not getattr(request, "is_preview", False)
+        and not request.user.is_authenticated
+    )
+
+
+def never_page_cache(view_func):
+    """ページ全体のキャッシュの対象外にするサブページのビューに付けるデコレーター"""
+
+    view_func.page_cache_exempt = True
+    return view_func
+
+
+def get_page_cache_key(request, page) -> str:
+    site = Site.find_for_request(request)
+    return PAGE_CACHE_KEY.format(
+        site_id=site.pk if site else 0,
+        page_id=page.pk,
+        version=get_page_version(page.pk),
+        path=hashlib.md5(request.path.encode()).hexdigest(),  # noqa: S324
+    )
+
+
+class PageCacheMixin:
+    """匿名ユーザー向けにページ全体(ルーティングしたサブページを含む)のHTMLをキャッシュする"""
+
+    def serve(self, request, *args, **kwargs):
+        timeout = get_page_cache_timeout()
+        # RoutablePageMixinの場合、args[0]はルーティングされたサブページのビュー
+        view = args[0] if args else None
+        if not timeout or not is_cacheable_request(request) or getattr(view, "page_cache_exempt", False):
+            return super().serve(request, *args, **kwargs)
+
+        key = get_page_cache_key(request, self)
+        cached = cache.get(key)
+        record_cache("page", cached is not None)
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(content.replace(CSRF_PLACEHOLDER, get_token(request)), content_type=content_type)
+            response["X-Polls-Cache"] = "hit"
+            return response
+
+        response = super().serve(request, *args, **kwargs)
+        if response.status_code != 200 or response.streaming:
+            return response
+        if hasattr(response, "render") and callable(response.render):
+            response.render()
+        content = CSRF_INPUT_RE.sub(rf"\g<1>{CSRF_PLACEHOLDER}\g<2>", response.content.decode(response.charset))
+        cache.set(key, (content, response["Content-Type"]), timeout)
+        response["X-Polls-Cache"] = "miss"
+        return response
@@ -0,0 +1,181 @@
+import hashlib
+import math
+import time
+from typing import Optional
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async  # type: ignore
+from django.conf import settings  # type: ignore
+from django.core.cache import cache  # type: ignore
+from django.http import HttpResponse  # type: ignore
+from django.utils.crypto import salted_hmac  # type: ignore
+
+from .votes import vote_queue
+
+RATE_KEY = "polls:vote-rate:{scope}:{key}"
+# Questionの投票(Question.vote)と非同期の投票ビュー(polls:vote)のパスの末尾
+VOTE_PATH_SUFFIX = "/vote/"
+WRITES_KEY = "polls:vote-writes-in-flight"
+# 書き込み中に強制終了したプロセスの分が残り続けないように、書き込み中の数は一定時間で0に戻す
+WRITES_TIMEOUT = 60
+
+
+def count_vote(key: str, rate: float, burst: int) -> float:
+    """burst/rate秒の固定ウィンドウごとの投票数を数える。burst以内なら0、超えた場合は次のウィンドウまでの秒数を返す
+
+    キャッシュのaddとincrだけを使うので、複数のプロセスが同時に数えても取りこぼさない。
+    ウィンドウの境目をまたぐと最大でburstの2倍まで通すことがある。
+    """
+
+    window = burst / rate
+    now = time.time()
+    index = int(now // window)
+    window_key = f"{key}:{index}"
+    cache.add(window_key, 0, timeout=math.ceil(window) + 1)
+    try:
+        count = cache.incr(window_key)
+    except ValueError:  # add直後にキーが追い出された場合
+        cache.set(window_key, 1, timeout=math.ceil(window) + 1)
+        count = 1
+    if count > burst:
+        return (index + 1) * window - now
+    return 0
+
+
+def get_client_key(request) -> str:
+    """レート制限に使うクライアントのIPアドレスのハッシュ
+
+    セッションのCookieは送る側が自由に変えられるので、投票者ごとの制限には使わない。
+    """
+
+    address = request.META.get("REMOTE_ADDR", "")
+    if not address:
+        return ""
+    return salted_hmac("polls.vote-rate", address, algorithm="sha256").hexdigest()
+
+
+def too_many_votes(wait: float) -> HttpResponse:
+    response = HttpResponse("Too many votes. Please try again later.\n", status=429, content_type="text/plain")
+    response["Retry-After"] = str(max(1, math.ceil(wait)))
+    return response
+
+
+def overloaded() -> HttpResponse:
+    response = HttpResponse("Voting is temporarily unavailable.\n", status=503, content_type="text/plain")
+    response["Retry-After"] = "1"
+    return response
+
+
+def is_vote_request(request) -> bool:
+    """Questionの投票(vote/)と非同期の投票ビューへのPOSTかどうか(データベースを使わずにパスで判断する)"""
+
+    return request.method == "POST" and request.path_info.endswith(VOTE_PATH_SUFFIX)
+
+
+def check_vote_limits(request) -> Optional[HttpResponse]:
+    """クライアントごと(POLLS_VOTE_CLIENT_RATE)と投票先のURLごと(POLLS_VOTE_QUESTION_RATE)の制限を超えた場合に429を返す"""
+
+    question_key = hashlib.blake2b(request.path_info.encode(), digest_size=16).hexdigest()
+    limits = [
+        ("client", get_client_key(request), "POLLS_VOTE_CLIENT_RATE", "POLLS_VOTE_CLIENT_BURST"),
+        ("question", question_key, "POLLS_VOTE_QUESTION_RATE", "POLLS_VOTE_QUESTION_BURST"),
+    ]
+    for scope, key, rate_setting, burst_setting in limits:
+        rate = getattr(settings, rate_setting, None)
+        if not rate or not key:
+            continue
+        burst = getattr(settings, burst_setting, None) or max(1, math.ceil(rate))
+        wait = count_vote(RATE_KEY.format(scope=scope, key=key), rate, burst)
+        if wait:
+            return too_many_votes(wait)
+    return None
+
+
+class WriteSlots:
+    """全てのプロセスで同時に書き込み中の投票の数を、共有するキャッシュ上のカウンターで数える
+
+    POLLS_VOTE_MAX_PENDING_WRITESを超える投票(このプロセスの書き込みキューの待ちを含む)は書き込まずに503を返し、
+    データベースを読み込みのために空けておく。
+    """
+
+    @property
+    def in_flight(self) -> int:
+        return cache.get(WRITES_KEY, 0)
+
+    def acquire(self) -> bool:
+        cache.add(WRITES_KEY, 0, timeout=WRITES_TIMEOUT)
+        try:
+            in_flight = cache.incr(WRITES_KEY)
+        except ValueError:  # add直後にキーが追い出された場合
+            cache.set(WRITES_KEY, 1, timeout=WRITES_TIMEOUT)
+            in_flight = 1
+        else:
+            # 書き込み中の投票がある間は期限を延ばし、途中で0に戻って解放時に負にならないようにする
+            cache.touch(WRITES_KEY, WRITES_TIMEOUT)
+        limit = getattr(settings, "POLLS_VOTE_MAX_PENDING_WRITES", None)
+        if limit and in_flight + vote_queue.pending() > limit:
+            self.release()
+            return False
+        return True
+
+    def release(self):
+        try:
+            in_flight = cache.decr(WRITES_KEY)
+        except ValueError:  # 期限切れや追い出しで消えた後
+            return
+        if in_flight < 0:
+            # 期限切れの後に作り直したキーから減らした場合は0に戻す
+            cache.incr(WRITES_KEY, -in_flight)
+
+
+write_slots = WriteSlots()
+
+
+def check_vote_request(request):
+    """投票のPOSTに制限をかけ、拒否する場合のレスポンスと書き込みの枠を取ったかどうかを返す"""
+
+    if not is_vote_request(request):
+        return None, False
+    rejected = check_vote_limits(request)
+    if rejected is not None:
+        return rejected, False
+    if not write_slots.acquire():
+        return overloaded(), False
+    return None, True
+
+
+class VoteLimitMiddleware:
+    """投票のPOSTに、ページのルーティング(サイトとページの検索)より前にレート制限と負荷による制限をかけるミドルウェア
+
+    クライアントのIPアドレスとパスだけで判断するので、拒否する投票ではデータベースを使わない。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        rejected, acquired = check_vote_request(request)
+        if rejected is not None:
+            return rejected
+        try:
+            return self.get_response(request)
+        finally:
+            if acquired:
+                write_slots.release()
+
+    async def __acall__(self, request):
+        # キャッシュのバックエンドが同期のみの場合があるのでスレッドで確認する
+        rejected, acquired = await sync_to_async(check_vote_request)(request)
+        if rejected is not None:
+            return rejected
+        try:
+            return await self.get_response(request)
+        finally:
+            if acquired:
+                write_slots.release()
@@ -0,0 +1,27 @@
+import logging
+
+from wagtail.images.models import SourceImageIOError  # type: ignore
+
+from .models import AUTHOR_IMAGE_FILTER
+
+logger = logging.getLogger(__name__)
+
+
+def warm_author_rendition(author) -> bool:
+    """作成者の画像のレンディションを作成しておき、ページ表示中に画像を縮小しないようにする
+
+    新しくレンディションを作成した場合はTrueを返す。
+    """
+
+    image = author.author_image
+    if image is None:
+        return False
+    existing = getattr(image, "prefetched_renditions", None)
+    if existing is not None and any(rendition.filter_spec == AUTHOR_IMAGE_FILTER for rendition in existing):
+        return False
+    try:
+        image.get_rendition(AUTHOR_IMAGE_FILTER)
+    except SourceImageIOError:
+        logger.warning("Source image file for author %s (image %s) is missing", author.pk, image.pk)
+        return False
+    return True
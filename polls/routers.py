@@ -0,0 +1,151 @@
+import contextvars
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction  # type: ignore
+from django.conf import settings  # type: ignore
+from django.db import DEFAULT_DB_ALIAS  # type: ignore
+
+# 投票したクライアントを一定時間プライマリに固定するCookie(値は固定を解除するUNIX時刻)
+PIN_COOKIE_NAME = "polls_pin_primary"
+# レプリカから読み込んでよいページ以外のアプリ(ページのモデルはアプリにかかわらず対象)
+REPLICA_APP_LABELS = {"polls", "home"}
+# レプリカを使わないパス(管理画面)
+REPLICA_EXCLUDED_PATHS = ("/admin/", "/django-admin/")
+
+_pinned: contextvars.ContextVar = contextvars.ContextVar("polls_pinned_to_primary", default=False)
+# レプリカから読み込んでよいリクエストの処理中かどうか(リクエストの外では常にプライマリ)
+_replica_request: contextvars.ContextVar = contextvars.ContextVar("polls_replica_request", default=False)
+
+
+def get_read_replicas():
+    """読み込みに使うレプリカのデータベースのエイリアスのリスト(POLLS_READ_REPLICAS)"""
+
+    return getattr(settings, "POLLS_READ_REPLICAS", [])
+
+
+def get_pin_seconds() -> int:
+    return getattr(settings, "POLLS_REPLICA_PIN_SECONDS", 10)
+
+
+def pin_to_primary(request=None):
+    """このリクエストの残りと、クライアントの以降のリクエストを一定時間プライマリから読み込ませる"""
+
+    _pinned.set(True)
+    if request is not None:
+        request.pin_to_primary = True
+
+
+def is_pinned_to_primary() -> bool:
+    return _pinned.get()
+
+
+def is_replica_request(request) -> bool:
+    """匿名ユーザーの管理画面以外へのGETとHEADかどうか
+
+    ログインの有無を確かめるにはセッションを読み込む必要があるので、セッションのCookieが無いことで判断する。
+    """
+
+    return (
+        request.method in ("GET", "HEAD")
+        and not request.path.startswith(REPLICA_EXCLUDED_PATHS)
+        and settings.SESSION_COOKIE_NAME not in request.COOKIES
+    )
+
+
+def is_replica_model(model) -> bool:
+    """レプリカから読み込んでよいモデル(ページとpollsのモデル)かどうか"""
+
+    from wagtail.models import Page  # type: ignore
+
+    return issubclass(model, Page) or model._meta.app_label in REPLICA_APP_LABELS
+
+
+class PrimaryReplicaRouter:
+    """書き込みはプライマリ(default)、読み込みはレプリカに振り分けるルーター
+
+    レプリカに振り分けるのは、ReplicaPinMiddlewareがレプリカを使ってよいと判断したリクエスト中の
+    ページとpollsのモデルの読み込みだけで、セッション・認証・管理画面・ページツリーの操作などは全てプライマリから読み込む。
+    投票後にプライマリに固定されている場合も振り分けない。
+    """
+
+    def db_for_read(self, model, **hints):
+        replicas = get_read_replicas()
+        if not replicas:
+            return None
+        if is_pinned_to_primary() or not _replica_request.get() or not is_replica_model(model):
+            # Noneを返すとレプリカから読み込んだインスタンスの関連もレプリカから読み込まれるので、明示する
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)  # noqa: S311
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_read_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # レプリカにはプライマリから複製されるので、マイグレーションはプライマリだけに行う
+        if db in get_read_replicas():
+            return False
+        return None
+
+
+class ReplicaPinMiddleware:
+    """レプリカを使ってよいリクエストかどうかを判断し、Cookieの期限内のリクエストはプライマリから読み込ませる
+
+    投票したレスポンスにはCookieを設定する。
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        tokens = self.process_request(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            self.reset(tokens)
+        return self.process_response(request, response)
+
+    async def __acall__(self, request):
+        tokens = self.process_request(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            self.reset(tokens)
+        return self.process_response(request, response)
+
+    def process_request(self, request):
+        try:
+            pinned_until = float(request.COOKIES.get(PIN_COOKIE_NAME, 0))
+        except ValueError:
+            pinned_until = 0
+        return _pinned.set(pinned_until > time.time()), _replica_request.set(is_replica_request(request))
+
+    def reset(self, tokens):
+        pinned_token, replica_token = tokens
+        _pinned.reset(pinned_token)
+        _replica_request.reset(replica_token)
+
+    def process_response(self, request, response):
+        if getattr(request, "pin_to_primary", False) and get_read_replicas():
+            seconds = get_pin_seconds()
+            response.set_cookie(
+                PIN_COOKIE_NAME,
+                str(int(time.time()) + seconds),
+                max_age=seconds,
+                httponly=True,
+                samesite="Lax",
+            )
+        return response
@@ -0,0 +1,45 @@
+import logging
+from typing import List, Optional
+
+from django.contrib.contenttypes.models import ContentType  # type: ignore
+from django.utils import timezone  # type: ignore
+from wagtail.models import Revision  # type: ignore
+
+from .models import Question
+from .warming import warm_questions
+
+logger = logging.getLogger(__name__)
+
+
+def get_due_revisions():
+    """公開日時(approved_go_live_at)を過ぎた予約済みのQuestionのリビジョン"""
+
+    return Revision.objects.filter(
+        content_type=ContentType.objects.get_for_model(Question),
+        approved_go_live_at__lte=timezone.now(),
+    ).order_by("approved_go_live_at", "pk")
+
+
+def publish_due_questions(limit: Optional[int] = None, warm: bool = True) -> List[Question]:
+    """予約済みで公開日時を過ぎたQuestionをまとめて公開し、公開したQuestionのキャッシュを作る
+
+    各リビジョンはwagtailのpublish_scheduledコマンドと同じように公開する(シグナルで古いキャッシュの破棄と索引の更新が行われる)。
+    全て公開した後に、親のPollsページを1回ずつ含めてキャッシュを作るので、公開直後のリクエストが一斉にレンダリングしない。
+    """
+
+    revisions = get_due_revisions()
+    if limit:
+        revisions = revisions[:limit]
+    question_ids = []
+    for revision in list(revisions):
+        try:
+            revision.publish(log_action="wagtail.publish.scheduled")
+        except Exception:
+            logger.exception("Failed to publish scheduled revision %s", revision.pk)
+            continue
+        question_ids.append(int(revision.object_id))
+
+    questions = list(Question.objects.live().filter(pk__in=question_ids).order_by("path"))
+    if warm and questions:
+        warm_questions(questions)
+    return questions
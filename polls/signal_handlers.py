@@ -0,0 +1,105 @@
+from django.conf import settings  # type: ignore
+from django.core.signals import request_finished  # type: ignore
+from django.db.backends.signals import connection_created  # type: ignore
+from django.db.models.signals import post_delete, post_save  # type: ignore
+from wagtail.search.index import remove_object  # type: ignore
+from wagtail.signals import page_published, page_unpublished  # type: ignore
+
+from .db import configure_sqlite_connection
+from .events import broker
+from .indexing import reindex_questions
+from .metrics import install_query_timer
+from .models import Author, Polls, Question
+from .page_cache import purge_page_cache
+from .renditions import warm_author_rendition
+from .signals import votes_changed
+from .tallies import invalidate_tallies
+from .votes import vote_buffer
+
+
+def invalidate_tallies_on_vote(sender, question_ids, **kwargs):
+    """票数が変わったQuestionの集計結果のキャッシュを破棄する"""
+
+    invalidate_tallies(question_ids)
+
+
+def invalidate_tally_on_publish(sender, instance, **kwargs):
+    """公開によってChoiceが変わった可能性があるので集計結果のキャッシュを破棄する"""
+
+    invalidate_tallies([instance.pk])
+
+
+def publish_tally_on_vote(sender, question_ids, **kwargs):
+    """このプロセスで結果を配信中の接続に更新を知らせる"""
+
+    broker.publish(question_ids)
+
+
+def purge_page_cache_on_vote(sender, question_ids, **kwargs):
+    """票数が変わったQuestionのページ(results/を含む)のキャッシュを破棄する"""
+
+    purge_page_cache(question_ids)
+
+
+def purge_page_cache_on_publish(sender, instance, **kwargs):
+    """公開・非公開にしたページと、それを一覧に表示する親のPollsページのキャッシュを破棄する"""
+
+    page_ids = [instance.pk]
+    if isinstance(instance, Question):
+        page_ids.append(instance.get_parent().pk)
+    purge_page_cache(page_ids)
+
+
+def warm_author_rendition_on_save(sender, instance, **kwargs):
+    """作成者の保存時に詳細ページで使う画像のレンディションを作成する"""
+
+    warm_author_rendition(instance)
+
+
+def purge_page_cache_on_author_save(sender, instance, **kwargs):
+    """作成者を表示しているQuestionのページのキャッシュを破棄する"""
+
+    purge_page_cache(Question.objects.filter(authors=instance).values_list("pk", flat=True))
+
+
+def reindex_question_on_publish(sender, instance, **kwargs):
+    """公開した内容(選択肢と作成者を含む)で検索の索引を更新する"""
+
+    reindex_questions([instance.pk])
+
+
+def remove_question_from_index_on_delete(sender, instance, **kwargs):
+    remove_object(instance)
+
+
+def reindex_questions_on_author_save(sender, instance, **kwargs):
+    """作成者名を索引に含んでいるQuestionをまとめて登録し直す"""
+
+    question_ids = list(Question.objects.filter(authors=instance).values_list("pk", flat=True))
+    if question_ids:
+        reindex_questions(question_ids)
+
+
+def flush_vote_buffer_on_request_finished(sender, **kwargs):
+    """POLLS_VOTE_MODEが"buffered"の場合に、このプロセスに溜めた増分を書き込む間隔が過ぎていれば書き込む"""
+
+    if getattr(settings, "POLLS_VOTE_MODE", "atomic") == "buffered":
+        vote_buffer.flush_if_due()
+
+
+def register_signal_handlers():
+    votes_changed.connect(invalidate_tallies_on_vote)
+    page_published.connect(invalidate_tally_on_publish, sender=Question)
+    votes_changed.connect(purge_page_cache_on_vote)
+    votes_changed.connect(publish_tally_on_vote)
+    for model in (Polls, Question):
+        page_published.connect(purge_page_cache_on_publish, sender=model)
+        page_unpublished.connect(purge_page_cache_on_publish, sender=model)
+    post_save.connect(warm_author_rendition_on_save, sender=Author)
+    post_save.connect(purge_page_cache_on_author_save, sender=Author)
+    page_published.connect(reindex_question_on_publish, sender=Question)
+    post_delete.connect(remove_question_from_index_on_delete, sender=Question)
+    post_save.connect(reindex_questions_on_author_save, sender=Author)
+    connection_created.connect(install_query_timer)
+    connection_created.connect(configure_sqlite_connection)
+    request_finished.connect(flush_vote_buffer_on_request_finished)
@@ -0,0 +1,5 @@
+from django.dispatch import Signal  # type: ignore
+
+# Choiceの投票数がデータベース上で変わった時に送信される
+# 引数: question_ids(投票数が変わったQuestionのidの集合)
+votes_changed = Signal()
@@ -0,0 +1,68 @@
+import time
+from typing import Optional
+
+from django.conf import settings  # type: ignore
+from django.core.cache import cache  # type: ignore
+from django.db import router  # type: ignore
+
+from . import models
+from .metrics import record_cache
+from .votes import get_choice_totals
+
+TALLY_KEY = "polls:tally:{}"
+TALLY_VERSION_KEY = "polls:tally-version:{}"
+
+
+def build_tally(question_id: int) -> dict:
+    """Questionの集計結果(Choiceのid・テキスト・票数と合計)をデータベースから作る"""
+
+    # 集計結果はキャッシュして全員に返すので、遅れのあるレプリカではなくプライマリから読み込む
+    choices = [
+        {"id": choice.pk, "text": choice.choice_text, "votes": choice.total_votes}
+        for choice in get_choice_totals(question_id).using(router.db_for_write(models.Choice))
+    ]
+    return {
+        "question_id": question_id,
+        "choices": choices,
+        "total": sum(choice["votes"] for choice in choices),
+    }
+
+
+def get_cached_tally(question_id: int) -> Optional[dict]:
+    """キャッシュにある集計結果だけを返す(データベースは使わない)"""
+
+    return cache.get(TALLY_KEY.format(question_id))
+
+
+def get_tally(question_id: int) -> dict:
+    """キャッシュにある集計結果を返す。無ければ作ってキャッシュする"""
+
+    tally = get_cached_tally(question_id)
+    record_cache("tally", tally is not None)
+    if tally is None:
+        tally = build_tally(question_id)
+        cache.set(TALLY_KEY.format(question_id), tally, getattr(settings, "POLLS_TALLY_CACHE_TIMEOUT", 300))
+    return tally
+
+
+def get_tally_version(question_id: int) -> int:
+    """集計結果が変わるたびに増えるバージョン(ETagに使う)を返す"""
+
+    key = TALLY_VERSION_KEY.format(question_id)
+    version = cache.get(key)
+    if version is None:
+        # キーが追い出された後に古いETagと一致しないよう、時刻から始める
+        cache.add(key, int(time.time() * 1000), timeout=None)
+        version = cache.get(key)
+    return version
+
+
+def invalidate_tallies(question_ids):
+    """集計結果のキャッシュを破棄してバージョンを上げる"""
+
+    cache.delete_many([TALLY_KEY.format(question_id) for question_id in question_ids])
+    for question_id in question_ids:
+        try:
+            cache.incr(TALLY_VERSION_KEY.format(question_id))
+        except ValueError:
+            get_tally_version(question_id)
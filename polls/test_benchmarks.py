@@ -0,0 +1,56 @@
+import json
+
+from django.core.cache import cache  # type: ignore
+from django.test import override_settings  # type: ignore
+from wagtail.models import Page  # type: ignore
+from wagtail.test.utils import WagtailPageTestCase  # type: ignore
+
+from .benchmarks import SCENARIOS, compare, get_scenarios, measure, run_benchmarks, seed_questions
+from .management.commands.benchmark import DEFAULT_BASELINE
+from .models import Choice, Question
+
+
+@override_settings(SEARCH_RECORD_HITS=False)
+class BenchmarkTests(WagtailPageTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_seed_questions(self):
+        """一括で作成したQuestionが木構造として正しく、公開済みで表示・検索できるアサート"""
+
+        polls = seed_questions(30, choices=4)
+        questions = Question.objects.child_of(polls).live()
+        self.assertEqual(questions.count(), 30)
+        self.assertEqual(Choice.objects.filter(question__in=questions).count(), 120)
+        self.assertEqual(Page.find_problems(), ([], [], [], [], []))
+
+        scenarios = get_scenarios(polls)
+        self.assertEqual(list(scenarios), SCENARIOS)
+        self.assertContains(scenarios["detail"](), "Choice Question 30-15 3")
+        self.assertContains(scenarios["search"](), "Question 30-15")
+        metrics = measure(scenarios["index"], iterations=3, warmup=1, memory_samples=2)
+        self.assertGreater(metrics["queries"], 0)
+
+    def test_compare(self):
+        """既定ではクエリ数が1つでも増えるか、メモリが許容する割合を超えたら基準値の超過になり、レイテンシは比べないアサート"""
+
+        baseline = {"10": {"index": {"p50_ms": 10, "p99_ms": 20, "queries": 5, "peak_kb": 100}}}
+        results = {"10": {"index": {"p50_ms": 30, "p99_ms": 60, "queries": 5, "peak_kb": 110}}}
+        self.assertEqual(compare(results, baseline), [])
+        self.assertEqual(len(compare(results, baseline, {"p50_ms": 0.5, "p99_ms": 0.5})), 2)
+
+        results["10"]["index"].update(queries=6, peak_kb=130)
+        self.assertEqual(len(compare(results, baseline)), 2)
+        self.assertEqual(compare(results, {}), [])
+
+    def test_queries_match_baseline(self):
+        """コミットしてある基準値(benchmarks/baseline.json)と比べて、各ビューのクエリ数が増えていないアサート"""
+
+        with open(DEFAULT_BASELINE, encoding="utf-8") as f:
+            baseline = json.load(f)
+        results = {"10": run_benchmarks(10, iterations=1)}
+        self.assertEqual(compare(results, baseline, {"queries": 0}), [])
+        self.assertEqual(
+            {name: metrics["queries"] for name, metrics in results["10"].items()},
+            {name: metrics["queries"] for name, metrics in baseline["10"].items()},
+        )
@@ -1,12 +1,27 @@
+import tempfile
+from datetime import datetime, time, timedelta
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.cache import cache  # type: ignore
+from django.core.management import call_command  # type: ignore
+from django.db import connection  # type: ignore
+from django.test import override_settings  # type: ignore
+from django.test.utils import CaptureQueriesContext  # type: ignore
 from django.urls import reverse  # type: ignore
 from django.utils import timezone  # type: ignore
+from wagtail.images import get_image_model  # type: ignore
+from wagtail.images.tests.utils import get_test_image_file  # type: ignore
 from wagtail.models import Page  # type: ignore
 from wagtail.test.utils import WagtailPageTestCase  # type: ignore
 from wagtail.test.utils.form_data import inline_formset, nested_form_data, rich_text  # type: ignore
 
 from home.models import HomePage
 
-from .models import Author, Polls, Question
+from .indexing import reindex_questions
+from .models import AUTHOR_IMAGE_FILTER, Author, Polls, Question
+from .scheduling import publish_due_questions
+from .warming import get_project_template_names
 
 
 class WagtailPagesTests(WagtailPageTestCase):
@@ -82,6 +97,19 @@ class WagtailPagesTests(WagtailPageTestCase):
         self.assertPageIsPreviewable(self.polls)
         self.assertPageIsPreviewable(self.question)
 
+    @override_settings(POLLS_PAGE_CACHE_TIMEOUT=60, SEARCH_RECORD_HITS=False)
+    def test_warmup_command(self):
+        """warmupコマンドでプロジェクトのテンプレートがコンパイルされ、サイトのルートとPolls・Questionのページがキャッシュされるアサート"""
+
+        cache.clear()
+        out = StringIO()
+        call_command("warmup", stdout=out)
+        self.assertIn("3 pages warmed (0 pages failed)", out.getvalue())
+        self.assertIn("polls/detail.html", get_project_template_names())
+        self.assertNotIn("wagtailadmin/base.html", get_project_template_names())
+        for page in [self.polls, self.question]:
+            self.assertEqual(self.client.get(page.url)["X-Polls-Cache"], "hit")
+
     def test_can_create_under_page(self):
         """親ページの下に作成できる子ページのアサート。
         似ているアサーションでassertAllowedParentPageTypesがある。"""
@@ -167,9 +195,8 @@ class PollsTests(WagtailPageTestCase):
 
         res = self.client.get("/polls/")
         query = (
-            Page.objects.type(Question)
-            .live()
-            .filter(question__pub_date__lte=timezone.now(), question__choices__choice_text__isnull=False)
+            Question.objects.live()
+            .filter(pub_date__lte=timezone.now(), choices__choice_text__isnull=False)
             .distinct()
             .order_by("-id")[:5]
         )
@@ -180,9 +207,43 @@ class PollsTests(WagtailPageTestCase):
 
         self.login()
         res = self.client.get("/polls/")
-        query = Page.objects.type(Question).all().order_by("-id")
+        query = Question.objects.all().order_by("-id")
         self.assertQuerysetEqual(res.context["pollspages"], query)
 
+    def test_polls_view_query_count(self):
+        """一覧に表示するQuestionの数が増えてもクエリ数が変わらないアサート"""
+
+        self.login()
+        self.client.get("/polls/")
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get("/polls/")
+        expected = len(queries)
+
+        for i in range(10):
+            question = Question(title=f"test {i}", pub_date=timezone.now())
+            question.choices.create(choice_text="choice", votes=0)
+            self.polls.add_child(instance=question)
+        with self.assertNumQueries(expected):
+            res = self.client.get("/polls/")
+        self.assertEqual(len(res.context["pollspages"]), 11)
+
+    def test_polls_view_sort(self):
+        """一覧をQuestionに非正規化した票数と最後の投票日時で並べ替えられるアサート"""
+
+        popular = Question(title="popular", pub_date=timezone.now(), total_votes=10)
+        popular.choices.create(choice_text="choice", votes=10)
+        self.polls.add_child(instance=popular)
+        Question.objects.filter(pk=self.question.pk).update(last_vote_at=timezone.now())
+
+        res = self.client.get("/polls/", {"sort": "popular"})
+        self.assertEqual(list(res.context["pollspages"]), [popular, self.question])
+        self.assertEqual(res.context["sort"], "popular")
+        res = self.client.get("/polls/", {"sort": "active"})
+        self.assertEqual(list(res.context["pollspages"]), [self.question, popular])
+        res = self.client.get("/polls/", {"sort": "unknown"})
+        self.assertEqual(list(res.context["pollspages"]), [popular, self.question])
+        self.assertEqual(res.context["sort"], "newest")
+
 
 class QuestionTests(WagtailPageTestCase):
     @classmethod
@@ -204,14 +265,16 @@ class QuestionTests(WagtailPageTestCase):
         # cls.polls.save_revision().publish()
         # cls.question.save_revision().publish()
 
+    @override_settings(POLLS_PAGE_CACHE_TIMEOUT=60)
     def test_question_admin_post_data(self):
-        """questionの作成で未来の日付に対して公開ページで作成した際のアサート"""
+        """questionの作成で未来の日付に対して公開すると予約され、公開日にコマンドで公開されてキャッシュが作られるアサート"""
 
         self.login()
+        pub_date = (timezone.now() + timezone.timedelta(days=2)).date()
         data = nested_form_data(
             {
                 "title": "test2",
-                "pub_date": (timezone.now() + timezone.timedelta(days=2)).date(),
+                "pub_date": pub_date,
                 "choices": inline_formset(
                     [
                         {"choice_text": "選択１", "votes": 0},
@@ -225,12 +288,26 @@ class QuestionTests(WagtailPageTestCase):
         )
         url = reverse("wagtailadmin_pages:add", args=[self.polls.slug, "question", self.polls.pk])
         res = self.client.post(url, data, follow=True)
-        # if res.redirect_chain == []:
-        #     print("redicrect_chainが空だった場合は[form]キーがある")
-        # else:
-        #     print("redirect_chain-----")
         self.assertEqual(res.status_code, 200)
-        self.assertContains(res, "未来の日付で保存する場合は非公開にする必要があります!!")
+        question = Question.objects.get(slug="test2")
+        go_live_at = timezone.make_aware(datetime.combine(pub_date, time.min))
+        self.assertFalse(question.live)
+        self.assertEqual(question.go_live_at, go_live_at)
+        self.assertEqual(question.get_latest_revision().approved_go_live_at, go_live_at)
+
+        # 公開日より前には公開しない
+        self.assertEqual(publish_due_questions(), [])
+        self.client.logout()
+        cache.clear()
+        with patch("django.utils.timezone.now", return_value=go_live_at + timedelta(minutes=1)):
+            self.assertEqual(publish_due_questions(), [question])
+        question.refresh_from_db()
+        self.assertTrue(question.live)
+        # 一覧・詳細・結果ページは最初のリクエストからキャッシュされている
+        for page_url in [self.polls.url, question.url, question.url + "results/"]:
+            res = self.client.get(page_url)
+            self.assertEqual(res["X-Polls-Cache"], "hit", page_url)
+        self.assertContains(self.client.get(self.polls.url), "test2")
 
     def test_choice_exception(self):
         """質問事項を選択せずに投票したあとのアサート"""
@@ -248,9 +325,92 @@ class QuestionTests(WagtailPageTestCase):
         self.assertRedirects(res, redirect_url)
 
 
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
 class AuthorTests(WagtailPageTestCase):
     def test_author_name(self):
         """Authorモデルのstrメソッドではname属性が返されるアサート"""
 
         author = Author(name="Wagtail")
         self.assertEqual(author.__str__(), "Wagtail")
+
+    def test_author_rendition(self):
+        """作成者の保存時に画像のレンディションが作成され、詳細ページのクエリ数が作成者の数によらないアサート"""
+
+        home = HomePage.objects.get(title="Home")
+        polls = Polls(title="Polls")
+        question = Question(title="test", pub_date=timezone.now())
+        question.choices.create(choice_text="Past choice 1.", votes=0)
+        question.choices.create(choice_text="Past choice 2.", votes=0)
+        home.add_child(instance=polls)
+        polls.add_child(instance=question)
+
+        authors = []
+        for i in range(3):
+            image = get_image_model().objects.create(title=f"image {i}", file=get_test_image_file())
+            author = Author.objects.create(name=f"author {i}", author_image=image)
+            self.assertTrue(image.renditions.filter(filter_spec=AUTHOR_IMAGE_FILTER).exists())
+            authors.append(author)
+
+        question.authors.set(authors[:1])
+        question.save()
+        self.client.get(question.url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(question.url)
+        expected = len(queries)
+
+        question.authors.set(authors)
+        question.save()
+        self.client.get(question.url)
+        with self.assertNumQueries(expected):
+            res = self.client.get(question.url)
+        self.assertContains(res, "author 2")
+
+        # 作成済みのレンディションは作り直さない
+        out = StringIO()
+        call_command("warm_author_renditions", stdout=out)
+        self.assertIn("0 renditions created.", out.getvalue())
+
+
+class QuestionSearchTests(WagtailPageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.home = HomePage.objects.get(title="Home")
+        cls.polls = Polls(title="Polls")
+        cls.home.add_child(instance=cls.polls)
+        cls.author = Author.objects.create(name="Hokusai")
+        cls.questions = []
+        for i in range(3):
+            question = Question(title=f"question {i}", pub_date=timezone.now())
+            question.choices.create(choice_text=f"Mackerel {i}", votes=0)
+            question.choices.create(choice_text=f"Bonito {i}", votes=0)
+            cls.polls.add_child(instance=question)
+            question.authors.add(cls.author)
+            question.save_revision().publish()
+            cls.questions.append(question)
+
+    def search(self, query):
+        return sorted(page.pk for page in Page.objects.live().search(query, operator="and"))
+
+    def test_search_choices_and_authors(self):
+        """公開すると選択肢のテキストと作成者名で検索でき、作成者名を変えると索引も更新されるアサート"""
+
+        self.assertEqual(self.search("Bonito 1"), [self.questions[1].pk])
+        self.assertEqual(len(self.search("Hokusai")), 3)
+
+        self.author.name = "Hiroshige"
+        self.author.save()
+        self.assertEqual(len(self.search("Hiroshige")), 3)
+        self.assertEqual(self.search("Hokusai"), [])
+
+    def test_reindex_questions_command(self):
+        """まとめて登録し直す際に選択肢と作成者をQuestionごとに取得しないアサート"""
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(reindex_questions([question.pk for question in self.questions]), 3)
+        self.assertEqual(len([query for query in queries if 'FROM "polls_choice"' in query["sql"]]), 1)
+        self.assertEqual(len([query for query in queries if 'FROM "polls_author"' in query["sql"]]), 1)
+
+        out = StringIO()
+        call_command("reindex_questions", "--chunk-size=2", stdout=out)
+        self.assertIn("3 questions indexed.", out.getvalue())
+        self.assertEqual(self.search("Mackerel 2"), [self.questions[2].pk])
@@ -0,0 +1,87 @@
+import re
+
+from django.core.cache import cache  # type: ignore
+from django.db import connection  # type: ignore
+from django.test import override_settings  # type: ignore
+from django.test.utils import CaptureQueriesContext  # type: ignore
+from wagtail.test.utils import WagtailPageTestCase  # type: ignore
+
+from .benchmarks import seed_questions
+from .models import Question
+
+# 全件を読む実行計画(SQLiteの「SCAN テーブル」とPostgreSQLの「Seq Scan」)。定数や副問い合わせの結果の読み込みは除く
+FULL_SCAN_PATTERNS = {
+    "sqlite": re.compile(r"\bSCAN (?!CONSTANT ROW|SUBQUERY)(\S+)"),
+    "postgresql": re.compile(r"Seq Scan on (\S+)"),
+}
+
+
+@override_settings(SEARCH_RECORD_HITS=False)
+class QueryPlanTests(WagtailPageTestCase):
+    """大きなデータで主要なビューのクエリの実行計画を確認し、pollsのテーブルを全件読むクエリがあれば失敗する"""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.polls = seed_questions(1000, choices=5)
+        # 他のPollsページの子ページを読まないことも確認する
+        seed_questions(100, choices=5)
+        questions = Question.objects.child_of(cls.polls).order_by("path")
+        cls.question = questions[500]
+        cls.choice = cls.question.choices.first()
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        cache.clear()
+        self.question_url = self.question.get_url()
+
+    def explain(self, sql):
+        prefix = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql)
+            return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
+
+    def assertNoFullScans(self, request):
+        """リクエストで実行されたpollsのテーブルのクエリを全てEXPLAINする"""
+
+        pattern = FULL_SCAN_PATTERNS.get(connection.vendor)
+        if pattern is None:
+            self.skipTest(f"Query plans are not checked on {connection.vendor}")
+        with CaptureQueriesContext(connection) as queries:
+            response = request()
+        self.assertLess(response.status_code, 400)
+        statements = [
+            query["sql"]
+            for query in queries
+            if "polls_" in query["sql"] and query["sql"].lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE"))
+        ]
+        self.assertTrue(statements)
+        for sql in statements:
+            plan = self.explain(sql)
+            self.assertIsNone(pattern.search(plan), f"Full scan in query plan:\n{plan}\nfor query:\n{sql}")
+
+    def test_index_plan(self):
+        """Pollsページの一覧(匿名ユーザー・並べ替え)"""
+
+        self.assertNoFullScans(lambda: self.client.get(self.polls.get_url()))
+        self.assertNoFullScans(lambda: self.client.get(self.polls.get_url(), {"sort": "popular"}))
+
+    def test_detail_plan(self):
+        """Questionの詳細ページ(選択肢と作成者)"""
+
+        self.assertNoFullScans(lambda: self.client.get(self.question_url))
+        if connection.vendor == "sqlite":
+            # 選択肢はQuestionとsort_orderの索引の順に読み、並べ替えない
+            plan = self.question.choices.all().explain()
+            self.assertIn("polls_choice_question_sort", plan)
+            self.assertNotIn("TEMP B-TREE", plan)
+
+    def test_results_plan(self):
+        """結果ページ(集計結果の作成)"""
+
+        self.assertNoFullScans(lambda: self.client.get(self.question_url + "results/"))
+
+    def test_vote_plan(self):
+        """投票(票数とQuestionの集計値の更新)"""
+
+        self.assertNoFullScans(lambda: self.client.post(self.question_url + "vote/", {"choice": self.choice.pk}))
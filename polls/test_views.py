@@ -0,0 +1,361 @@
+import asyncio
+import csv
+import json
+import os
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+
+from asgiref.sync import async_to_sync, sync_to_async  # type: ignore
+from django.core.cache import cache  # type: ignore
+from django.core.management import call_command  # type: ignore
+from django.test import AsyncClient, Client, override_settings  # type: ignore
+from django.urls import reverse  # type: ignore
+from django.utils import timezone  # type: ignore
+from wagtail.models import PageViewRestriction  # type: ignore
+from wagtail.test.utils import WagtailPageTestCase  # type: ignore
+
+from home.models import HomePage
+
+from .events import broker, stream_tally
+from .exports import EXPORT_FIELDS
+from .metrics import registry
+from .models import Polls, Question
+from .ratelimit import write_slots
+from .routers import PIN_COOKIE_NAME
+from .votes import VoteWriteQueue, record_vote, vote_queue
+
+
+@override_settings(POLLS_PAGE_CACHE_TIMEOUT=60)
+class PageCacheTests(WagtailPageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.home = HomePage.objects.get(title="Home")
+        cls.polls = Polls(title="Polls")
+        cls.question = Question(title="test", pub_date=timezone.now())
+        cls.question.choices.create(choice_text="Past choice 1.", votes=0)
+        cls.question.choices.create(choice_text="Past choice 2.", votes=0)
+
+        cls.home.add_child(instance=cls.polls)
+        cls.polls.add_child(instance=cls.question)
+        cls.polls.save_revision().publish()
+        cls.question.save_revision().publish()
+
+    def setUp(self):
+        cache.clear()
+
+    def test_anonymous_page_cache(self):
+        """匿名ユーザーの2回目以降のアクセスはキャッシュから返され、ログインユーザーはキャッシュしないアサート"""
+
+        self.assertEqual(self.client.get("/polls/")["X-Polls-Cache"], "miss")
+        self.assertEqual(self.client.get("/polls/")["X-Polls-Cache"], "hit")
+        self.assertEqual(self.client.get(self.question.url)["X-Polls-Cache"], "miss")
+        self.assertEqual(self.client.get(self.question.url)["X-Polls-Cache"], "hit")
+
+        self.login()
+        self.assertNotIn("X-Polls-Cache", self.client.get("/polls/"))
+
+    def test_cached_vote_form_csrf(self):
+        """キャッシュしたページのフォームでも、リクエストごとのCSRFトークンで投票できるアサート"""
+
+        self.client.get(self.question.url)
+        client = Client(enforce_csrf_checks=True)
+        res = client.get(self.question.url)
+        self.assertEqual(res["X-Polls-Cache"], "hit")
+        token = res.content.decode().split('name="csrfmiddlewaretoken" value="')[1].split('"')[0]
+        self.assertNotEqual(token, "__polls_csrf_token__")
+
+        choice = self.question.choices.first()
+        res = client.post(self.question.url + "vote/", {"choice": choice.pk, "csrfmiddlewaretoken": token})
+        self.assertEqual(res.status_code, 302)
+
+    def test_page_cache_purge(self):
+        """投票するとresults/のキャッシュが、公開すると親の一覧のキャッシュが破棄されるアサート"""
+
+        results_url = self.question.url + "results/"
+        self.client.get(results_url)
+        self.client.get("/polls/")
+        self.client.post(self.question.url + "vote/", {"choice": self.question.choices.first().pk})
+        res = self.client.get(results_url)
+        self.assertEqual(res["X-Polls-Cache"], "miss")
+        self.assertContains(res, "1 vote<")
+
+        self.assertEqual(self.client.get("/polls/")["X-Polls-Cache"], "hit")
+        self.question.save_revision().publish()
+        self.assertEqual(self.client.get("/polls/")["X-Polls-Cache"], "miss")
+
+
+class ResultsJsonTests(WagtailPageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.home = HomePage.objects.get(title="Home")
+        cls.polls = Polls(title="Polls")
+        cls.question = Question(title="test", pub_date=timezone.now())
+        cls.question.choices.create(choice_text="Past choice 1.", votes=0)
+        cls.question.choices.create(choice_text="Past choice 2.", votes=0)
+
+        cls.home.add_child(instance=cls.polls)
+        cls.polls.add_child(instance=cls.question)
+        cls.polls.save_revision().publish()
+        cls.question.save_revision().publish()
+
+    def setUp(self):
+        cache.clear()
+        self.url = self.question.url + "results/json/"
+
+    @override_settings(POLLS_PAGE_CACHE_TIMEOUT=60)
+    def test_results_json_etag(self):
+        """結果のJSONにETagが付き、変わっていなければ304、投票後は新しい結果を返すアサート"""
+
+        self.assertPageIsRoutable(self.question, route_path="results/json/")
+        res = self.client.get(self.url)
+        self.assertEqual(res.json()["total"], 0)
+        self.assertEqual([choice["text"] for choice in res.json()["choices"]], ["Past choice 1.", "Past choice 2."])
+        etag = res["ETag"]
+
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 304)
+        self.assertEqual(res["ETag"], etag)
+
+        self.client.post(self.question.url + "vote/", {"choice": self.question.choices.first().pk})
+        res = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(res.status_code, 200)
+        self.assertNotEqual(res["ETag"], etag)
+        self.assertEqual(res.json()["total"], 1)
+
+    def test_results_stream_wsgi(self):
+        """WSGIでは現在の結果を1回だけ送り、再接続の間隔を指定するアサート"""
+
+        res = self.client.get(self.question.url + "results/stream/")
+        self.assertEqual(res["Content-Type"], "text/event-stream")
+        content = res.content.decode()
+        self.assertTrue(content.startswith("retry: "))
+        self.assertIn('"total": 0', content)
+        version = content.split("id: ")[1].split("\n")[0]
+
+        res = self.client.get(self.question.url + "results/stream/", HTTP_LAST_EVENT_ID=version)
+        self.assertNotIn("event: tally", res.content.decode())
+
+    @override_settings(POLLS_SSE_MIN_INTERVAL=0, POLLS_SSE_POLL_INTERVAL=5)
+    def test_stream_tally(self):
+        """配信中に票が入ると、次のイベントで新しい結果が送られるアサート"""
+
+        choice = self.question.choices.first()
+
+        async def read_events():
+            stream = stream_tally(self.question.pk)
+            first = await stream.__anext__()
+            await sync_to_async(record_vote)(choice)
+            second = await asyncio.wait_for(stream.__anext__(), timeout=2)
+            await stream.aclose()
+            return first, second
+
+        first, second = async_to_sync(read_events)()
+        self.assertIn('"total": 0', first)
+        self.assertIn('"total": 1', second)
+        self.assertFalse(broker._subscribers)
+
+
+@override_settings(POLLS_ASYNC_VOTE=True)
+class AsyncVoteTests(WagtailPageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.home = HomePage.objects.get(title="Home")
+        cls.polls = Polls(title="Polls")
+        cls.question = Question(title="test", pub_date=timezone.now())
+        cls.question.choices.create(choice_text="Past choice 1.", votes=0)
+        cls.question.choices.create(choice_text="Past choice 2.", votes=0)
+
+        cls.home.add_child(instance=cls.polls)
+        cls.polls.add_child(instance=cls.question)
+        cls.polls.save_revision().publish()
+        cls.question.save_revision().publish()
+
+    def async_request(self, method, url, data=None):
+        async def request():
+            return await getattr(AsyncClient(), method)(url, data or {})
+
+        return async_to_sync(request)()
+
+    def test_async_vote(self):
+        """詳細ページのフォームが非同期の投票ビューに送信され、投票後に結果ページへリダイレクトするアサート"""
+
+        url = reverse("polls:vote", args=[self.question.pk])
+        self.assertContains(self.client.get(self.question.url), f'action="{url}"')
+
+        choice = self.question.choices.first()
+        res = self.async_request("post", url, {"choice": choice.pk})
+        self.assertRedirects(res, self.question.url + "results/", fetch_redirect_response=False)
+        choice.refresh_from_db()
+        self.assertEqual(choice.votes, 1)
+
+        res = self.async_request("post", url)
+        self.assertEqual(res.context["error_message"], "You didn't select a choice.")
+        self.assertEqual(self.async_request("get", url).status_code, 405)
+
+        # 重複投票の防止を有効にすると2回目の投票は拒否される
+        Question.objects.filter(pk=self.question.pk).update(prevent_duplicate_votes=True)
+        self.assertEqual(self.async_request("post", url, {"choice": choice.pk}).status_code, 302)
+        res = self.async_request("post", url, {"choice": choice.pk})
+        self.assertEqual(res.status_code, 409)
+        choice.refresh_from_db()
+        self.assertEqual(choice.votes, 2)
+
+    @override_settings(POLLS_ASYNC_VOTE_QUEUE=True, POLLS_READ_REPLICAS=["replica"])
+    def test_async_vote_queue_pins_primary(self):
+        """書き込みキューに入れた投票でも、レスポンスにプライマリに固定するCookieが設定されるアサート"""
+
+        url = reverse("polls:vote", args=[self.question.pk])
+        choice = self.question.choices.first()
+        with patch.object(vote_queue, "put") as put:
+            res = self.async_request("post", url, {"choice": choice.pk})
+        self.assertEqual(res.status_code, 302)
+        put.assert_called_once()
+        self.assertIn(PIN_COOKIE_NAME, res.cookies)
+
+    def test_async_vote_view_restrictions(self):
+        """閲覧制限のあるQuestionには、制限を満たさないと非同期の投票ビューからも投票できないアサート"""
+
+        url = reverse("polls:vote", args=[self.question.pk])
+        choice = self.question.choices.first()
+        restriction = PageViewRestriction.objects.create(
+            page=self.question, restriction_type=PageViewRestriction.PASSWORD, password="secret"
+        )
+        res = self.async_request("post", url, {"choice": choice.pk})
+        self.assertEqual(res.status_code, 200)
+        self.assertTemplateUsed(res, "wagtailcore/password_required.html")
+
+        restriction.restriction_type = PageViewRestriction.LOGIN
+        restriction.save()
+        res = self.async_request("post", url, {"choice": choice.pk})
+        self.assertEqual(res.status_code, 302)
+        self.assertNotEqual(res["Location"], self.question.url + "results/")
+        choice.refresh_from_db()
+        self.assertEqual(choice.votes, 0)
+
+        restriction.delete()
+        self.assertEqual(self.async_request("post", url, {"choice": choice.pk}).status_code, 302)
+        choice.refresh_from_db()
+        self.assertEqual(choice.votes, 1)
+
+    @override_settings(POLLS_VOTE_MAX_PENDING_WRITES=1)
+    def test_vote_load_shedding(self):
+        """書き込み中の投票が上限に達していると503を返し、書き込みが終われば受け付けるアサート"""
+
+        url = reverse("polls:vote", args=[self.question.pk])
+        choice = self.question.choices.first()
+        self.assertTrue(write_slots.acquire())
+        try:
+            res = self.async_request("post", url, {"choice": choice.pk})
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(res["Retry-After"], "1")
+        finally:
+            write_slots.release()
+        self.assertEqual(self.async_request("post", url, {"choice": choice.pk}).status_code, 302)
+        self.assertEqual(write_slots.in_flight, 0)
+
+    def test_vote_write_queue(self):
+        """書き込みキューに入れた投票がバックグラウンドのスレッドで順番に書き込まれるアサート"""
+
+        written = []
+        write_queue = VoteWriteQueue(writer=lambda choice, request: written.append(choice))
+        for choice in self.question.choices.all():
+            write_queue.put(choice)
+        write_queue.join()
+        write_queue.stop()
+        self.assertEqual(written, list(self.question.choices.all()))
+
+
+class ExportTests(WagtailPageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.home = HomePage.objects.get(title="Home")
+        cls.polls = Polls(title="Polls")
+        cls.home.add_child(instance=cls.polls)
+        for i in range(3):
+            question = Question(title=f"test {i}", pub_date=timezone.now())
+            question.choices.create(choice_text=f"choice {i}-1", votes=i)
+            question.choices.create(choice_text=f"choice {i}-2", votes=0)
+            cls.polls.add_child(instance=question)
+
+    def test_export_results_command(self):
+        """exportコマンドでPollsページ以下の全てのChoiceが1行ずつ書き出されるアサート"""
+
+        out = StringIO()
+        call_command("export_results", self.polls.pk, stdout=out)
+        rows = list(csv.reader(StringIO(out.getvalue())))
+        self.assertEqual(rows[0], EXPORT_FIELDS)
+        self.assertEqual(len(rows), 7)
+        self.assertEqual([rows[5][1], rows[5][4], rows[5][5]], ["test 2", "choice 2-1", "2"])
+
+        out = StringIO()
+        call_command("export_results", "--format=jsonl", stdout=out)
+        self.assertEqual(json.loads(out.getvalue().splitlines()[0])["choice_text"], "choice 0-1")
+
+    def test_export_results_admin(self):
+        """管理画面からストリーミングで投票結果をダウンロードできるアサート"""
+
+        self.login()
+        res = self.client.get(reverse("polls_export_results", args=[self.polls.pk]))
+        self.assertTrue(res.streaming)
+        self.assertEqual(res["Content-Type"], "text/csv")
+        self.assertEqual(len(b"".join(res.streaming_content).decode().splitlines()), 7)
+
+        res = self.client.get(reverse("wagtailadmin_explore", args=[self.home.pk]))
+        self.assertContains(res, reverse("polls_export_results", args=[self.polls.pk]))
+
+
+class MetricsTests(WagtailPageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.home = HomePage.objects.get(title="Home")
+        cls.polls = Polls(title="Polls")
+        cls.question = Question(title="test", pub_date=timezone.now())
+        cls.question.choices.create(choice_text="Past choice 1.", votes=0)
+        cls.question.choices.create(choice_text="Past choice 2.", votes=0)
+
+        cls.home.add_child(instance=cls.polls)
+        cls.polls.add_child(instance=cls.question)
+        cls.polls.save_revision().publish()
+        cls.question.save_revision().publish()
+
+    def setUp(self):
+        cache.clear()
+        registry.reset()
+
+    def test_metrics(self):
+        """ページの種類とサブページごとにレイテンシとクエリ数、キャッシュのヒットが集計されるアサート"""
+
+        choice = self.question.choices.first()
+        self.client.get(self.polls.url)
+        self.client.post(self.question.url + "vote/", {"choice": choice.pk})
+        self.client.get(self.question.url + "results/")
+        self.client.get(self.question.url + "results/")
+
+        res = self.client.get("/metrics")
+        self.assertEqual(res["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        content = res.content.decode()
+        self.assertIn('polls_http_request_duration_seconds_count{route="polls.polls"} 1', content)
+        self.assertIn('polls_http_responses_total{route="polls.question.vote",status="302"} 1', content)
+        self.assertIn('polls_http_request_duration_seconds_bucket{route="polls.question.results",le="+Inf"} 2', content)
+        self.assertIn('polls_cache_requests_total{cache="tally",result="hit"} 1', content)
+        self.assertNotIn('route="metrics"', content)
+        queries = next(line for line in content.splitlines() if 'polls_db_queries_total{route="polls.polls"}' in line)
+        self.assertGreater(int(queries.split()[-1]), 0)
+
+    def test_metrics_shared_across_workers(self):
+        """他のワーカーが書き出した集計結果と合計され、トークンを設定すると認証が必要になるアサート"""
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(
+            POLLS_METRICS_DIR=directory, POLLS_METRICS_TOKEN="secret"
+        ):
+            self.client.get(self.polls.url)
+            registry.write()
+            # 書き出した集計結果を別のワーカーのものにする
+            os.rename(registry.get_path(), os.path.join(directory, "metrics-0.json"))
+            registry.reset()
+            self.client.get(self.polls.url)
+
+            self.assertEqual(self.client.get("/metrics").status_code, 403)
+            res = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        self.assertContains(res, 'polls_http_request_duration_seconds_count{route="polls.polls"} 2')
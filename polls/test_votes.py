@@ -0,0 +1,433 @@
+import os
+import tempfile
+import threading
+import time
+from io import StringIO
+
+from django.conf import settings  # type: ignore
+from django.contrib.sessions.models import Session  # type: ignore
+from django.core.cache import cache  # type: ignore
+from django.core.exceptions import ImproperlyConfigured  # type: ignore
+from django.core.management import call_command  # type: ignore
+from django.db import connection  # type: ignore
+from django.db.backends.sqlite3.base import DatabaseWrapper  # type: ignore
+from django.http import HttpResponse  # type: ignore
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings  # type: ignore
+from django.test.utils import CaptureQueriesContext  # type: ignore
+from django.utils import timezone  # type: ignore
+from wagtail.models import Page  # type: ignore
+from wagtail.test.utils import WagtailPageTestCase  # type: ignore
+
+from home.models import HomePage
+
+from .checks import check_shared_cache, check_vote_cache
+from .db import serialized_write
+from .ratelimit import WRITES_KEY, write_slots
+from .models import Choice, ChoiceVoteShard, Polls, Question, VoteEvent, VoteGuardFilter, VoteRollup
+from .routers import PIN_COOKIE_NAME, PrimaryReplicaRouter, ReplicaPinMiddleware, pin_to_primary
+from .tallies import TALLY_KEY, get_tally
+from .vote_guard import check_and_add, get_filter_params, save_filter
+from .votes import (
+    VOTE_DELTA_KEY,
+    apply_vote_deltas,
+    get_choice_totals,
+    get_vote_mode,
+    recompute_question_totals,
+    rollup_vote_events,
+    vote_buffer,
+)
+
+
+class VoteTests(WagtailPageTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.home = HomePage.objects.get(title="Home")
+        cls.polls = Polls(title="Polls")
+        cls.question = Question(title="test", pub_date=timezone.now())
+        cls.question.choices.create(choice_text="Past choice 1.", votes=0)
+        cls.question.choices.create(choice_text="Past choice 2.", votes=0)
+
+        cls.home.add_child(instance=cls.polls)
+        cls.polls.add_child(instance=cls.question)
+        cls.polls.save_revision().publish()
+        cls.question.save_revision().publish()
+
+    def setUp(self):
+        cache.clear()
+        vote_buffer.flush()
+        self.choice1, self.choice2 = self.question.choices.all()
+        self.vote_url = self.question.url + self.question.reverse_subpage("vote")
+
+    def test_atomic_vote(self):
+        """投票するとデータベース側で1票加算されるアサート"""
+
+        res = self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        # レプリカが無ければプライマリに固定するCookieは設定しない
+        self.assertNotIn(PIN_COOKIE_NAME, res.cookies)
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        self.choice1.refresh_from_db()
+        self.assertEqual(self.choice1.votes, 2)
+
+    def test_question_vote_totals(self):
+        """投票でQuestionのtotal_votes・leading_choice・last_vote_atが更新され、リビジョンを公開しても残るアサート"""
+
+        self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        question = Question.objects.get(pk=self.question.pk)
+        self.assertEqual(question.total_votes, 3)
+        self.assertEqual(question.leading_choice_id, self.choice2.pk)
+        self.assertIsNotNone(question.last_vote_at)
+
+        # 投票前に作成したリビジョンを公開しても票数は戻らない
+        question.get_latest_revision().publish()
+        question = Question.objects.get(pk=self.question.pk)
+        self.assertEqual(question.total_votes, 3)
+        self.assertEqual(Choice.objects.get(pk=self.choice2.pk).votes, 2)
+
+        # リビジョンから復元してから保存するまでの投票も失われない
+        page = question.get_latest_revision().as_object()
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        page.save()
+        question.refresh_from_db()
+        self.assertEqual(question.total_votes, 4)
+        self.assertEqual(Choice.objects.get(pk=self.choice1.pk).votes, 2)
+
+        Question.objects.filter(pk=question.pk).update(total_votes=0, leading_choice=None)
+        ChoiceVoteShard.objects.create(choice=self.choice1, shard=0, votes=5)
+        out = StringIO()
+        call_command("recompute_question_totals", stdout=out)
+        self.assertIn("1 questions recomputed.", out.getvalue())
+        question.refresh_from_db()
+        self.assertEqual((question.total_votes, question.leading_choice_id), (9, self.choice1.pk))
+
+    def test_copy_question_vote_totals(self):
+        """コピーしたQuestionの集計値が、コピー元ではなくコピーしたChoiceを指すアサート"""
+
+        self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        question = Question.objects.get(pk=self.question.pk)
+        self.assertEqual(question.leading_choice_id, self.choice2.pk)
+
+        page_copy = question.copy(update_attrs={"slug": "copied-question", "title": "Copied question"})
+        page_copy = Question.objects.get(pk=page_copy.pk)
+        copied_choices = list(page_copy.choices.order_by("sort_order"))
+        self.assertEqual([choice.votes for choice in copied_choices], [0, 2])
+        self.assertEqual(page_copy.leading_choice_id, copied_choices[1].pk)
+        self.assertEqual(page_copy.total_votes, 2)
+        self.assertIsNone(page_copy.last_vote_at)
+        self.assertEqual(page_copy.get_latest_revision().content.get("leading_choice"), None)
+
+    def test_apply_vote_deltas(self):
+        """複数のChoiceの増分が1回のUPDATEで反映されるアサート"""
+
+        with self.assertNumQueries(1):
+            apply_vote_deltas({self.choice1.pk: 3, self.choice2.pk: 5})
+        self.choice1.refresh_from_db()
+        self.choice2.refresh_from_db()
+        self.assertEqual((self.choice1.votes, self.choice2.votes), (3, 5))
+
+    @override_settings(POLLS_VOTE_MODE="buffered", POLLS_VOTE_BUFFER_MAX_VOTES=3, POLLS_VOTE_BUFFER_INTERVAL_MS=60000)
+    def test_buffered_vote(self):
+        """write-behindモードでは指定の票数が溜まるまでデータベースに書き込まないアサート"""
+
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.choice1.refresh_from_db()
+        self.assertEqual(self.choice1.votes, 0)
+        self.assertEqual(cache.get(VOTE_DELTA_KEY.format(self.choice1.pk)), 1)
+
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        self.choice1.refresh_from_db()
+        self.choice2.refresh_from_db()
+        self.assertEqual((self.choice1.votes, self.choice2.votes), (2, 1))
+        self.assertEqual(cache.get(VOTE_DELTA_KEY.format(self.choice1.pk)), 0)
+
+    @override_settings(POLLS_VOTE_MODE="buffered", POLLS_VOTE_BUFFER_MAX_VOTES=100, POLLS_VOTE_BUFFER_INTERVAL_MS=60000)
+    def test_flush_votes_command(self):
+        """flush_votesコマンドで溜まっている増分が書き込まれるアサート"""
+
+        self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        call_command("flush_votes", stdout=StringIO())
+        self.assertEqual(Choice.objects.get(pk=self.choice2.pk).votes, 1)
+
+    @override_settings(POLLS_VOTE_MODE="buffered", POLLS_VOTE_BUFFER_MAX_VOTES=100, POLLS_VOTE_BUFFER_INTERVAL_MS=60000)
+    def test_buffered_vote_flushed_after_interval(self):
+        """投票が途絶えても、間隔が過ぎた後のリクエストの終了時に溜まった増分が書き込まれるアサート"""
+
+        vote_buffer.flush()
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        self.client.get(self.question.url)
+        self.assertEqual(Choice.objects.get(pk=self.choice1.pk).votes, 0)
+        with override_settings(POLLS_VOTE_BUFFER_INTERVAL_MS=0):
+            self.client.get(self.question.url)
+        self.assertEqual(Choice.objects.get(pk=self.choice1.pk).votes, 1)
+
+        # incrが不可分でないキャッシュでは"buffered"を使わせない
+        file_cache = {"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": "/tmp"}}
+        with override_settings(CACHES=file_cache), self.assertRaises(ImproperlyConfigured):
+            get_vote_mode()
+
+    @override_settings(POLLS_VOTE_MODE="sharded", POLLS_VOTE_SHARDS=4)
+    def test_sharded_vote(self):
+        """分割カウンターモードではシャードに加算され、結果ページにはChoice.votesとの合計が表示されるアサート"""
+
+        Choice.objects.filter(pk=self.choice1.pk).update(votes=10)
+        for _ in range(20):
+            self.client.post(self.vote_url, {"choice": self.choice1.pk})
+
+        shards = ChoiceVoteShard.objects.filter(choice=self.choice1)
+        self.assertLessEqual(shards.count(), 4)
+        self.assertEqual(sum(shard.votes for shard in shards), 20)
+        self.assertEqual([choice.total_votes for choice in get_choice_totals(self.question)], [30, 0])
+
+        res = self.client.get(self.question.url + "results/")
+        self.assertContains(res, "Past choice 1. -- 30 votes")
+        self.assertContains(res, "Past choice 2. -- 0 votes")
+
+        # Questionの集計値は投票ごとには更新せず、最近投票があったQuestionだけをまとめて計算し直す
+        question = Question.objects.get(pk=self.question.pk)
+        self.assertEqual((question.total_votes, question.last_vote_at), (0, None))
+        self.assertEqual(recompute_question_totals(since=timezone.now() + timezone.timedelta(minutes=1)), 0)
+        self.assertEqual(recompute_question_totals(since=timezone.now() - timezone.timedelta(minutes=1)), 1)
+        question.refresh_from_db()
+        self.assertEqual((question.total_votes, question.leading_choice_id), (30, self.choice1.pk))
+        self.assertEqual(question.last_vote_at, shards.order_by("-updated_at").first().updated_at)
+
+    @override_settings(POLLS_VOTE_MODE="log")
+    def test_vote_event_log(self):
+        """投票ログモードではVoteEventが追記され、rollup_votesで前回の位置から集計されるアサート"""
+
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.assertEqual(VoteEvent.objects.count(), 2)
+        self.assertEqual(len(VoteEvent.objects.first().voter_hash), 64)
+        self.choice1.refresh_from_db()
+        self.assertEqual(self.choice1.votes, 0)
+
+        call_command("rollup_votes", "--lag=0", stdout=StringIO())
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        self.assertEqual(rollup_vote_events(batch_size=1, lag=0), 1)
+        self.assertEqual(rollup_vote_events(lag=0), 0)
+
+        self.choice1.refresh_from_db()
+        self.choice2.refresh_from_db()
+        self.assertEqual((self.choice1.votes, self.choice2.votes), (2, 1))
+        self.assertEqual(VoteRollup.objects.get().last_event_id, VoteEvent.objects.last().pk)
+        self.assertEqual(Question.objects.get(pk=self.question.pk).total_votes, 3)
+
+    def test_results_tally_cache(self):
+        """2回目以降の結果ページではChoiceを読み込まず、投票するとキャッシュが破棄されるアサート"""
+
+        results_url = self.question.url + "results/"
+        self.client.get(results_url)
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get(results_url)
+        self.assertFalse([query for query in queries if "polls_choice" in query["sql"]])
+        self.assertContains(res, "Past choice 1. -- 0 votes")
+
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        self.assertIsNone(cache.get(TALLY_KEY.format(self.question.pk)))
+        res = self.client.get(results_url)
+        self.assertContains(res, "Past choice 1. -- 1 vote<")
+        self.assertEqual(get_tally(self.question.pk)["total"], 1)
+
+        self.question.save_revision().publish()
+        self.assertIsNone(cache.get(TALLY_KEY.format(self.question.pk)))
+
+    @override_settings(POLLS_VOTE_CLIENT_RATE=0.001, POLLS_VOTE_CLIENT_BURST=2, POLLS_VOTE_QUESTION_RATE=0.001)
+    def test_vote_rate_limits(self):
+        """クライアントごととQuestionごとの上限を超えるとデータベースを使わずに429が返るアサート"""
+
+        self.assertEqual(self.client.post(self.vote_url, {"choice": self.choice1.pk}).status_code, 302)
+        # Questionの上限(既定で1票)を超えているので、ページのルーティングより前に拒否してクエリを実行しない
+        with self.assertNumQueries(0):
+            res = self.client.post(self.vote_url, {"choice": self.choice1.pk}, REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(res.status_code, 429)
+        self.assertTrue(1 <= int(res["Retry-After"]) <= 1000)
+
+        with override_settings(POLLS_VOTE_QUESTION_RATE=None):
+            self.assertEqual(self.client.post(self.vote_url, {"choice": self.choice1.pk}).status_code, 302)
+            self.assertEqual(self.client.post(self.vote_url, {"choice": self.choice1.pk}).status_code, 429)
+            # セッションのCookieを変えてもクライアントごとの制限は避けられない
+            self.client.cookies[settings.SESSION_COOKIE_NAME] = "unknown-session-key"
+            self.assertEqual(self.client.post(self.vote_url, {"choice": self.choice1.pk}).status_code, 429)
+        self.choice1.refresh_from_db()
+        self.assertEqual(self.choice1.votes, 2)
+
+    @override_settings(POLLS_VOTE_MAX_PENDING_WRITES=1)
+    def test_vote_load_shedding_without_queries(self):
+        """書き込み中の投票が上限に達していると、クエリを実行せずに503を返し、書き込みの枠を戻すアサート"""
+
+        self.assertTrue(write_slots.acquire())
+        try:
+            with self.assertNumQueries(0):
+                res = self.client.post(self.vote_url, {"choice": self.choice1.pk})
+            self.assertEqual(res.status_code, 503)
+            self.assertEqual(write_slots.in_flight, 1)
+        finally:
+            write_slots.release()
+        self.assertEqual(write_slots.in_flight, 0)
+        # 期限切れで作り直したカウンターから減らしても負にならない
+        cache.delete(WRITES_KEY)
+        write_slots.release()
+        self.assertEqual(write_slots.in_flight, 0)
+        cache.set(WRITES_KEY, 0)
+        write_slots.release()
+        self.assertEqual(write_slots.in_flight, 0)
+
+    @override_settings(POLLS_VOTE_GUARD_CAPACITY=1000, POLLS_VOTE_GUARD_SAVE_EVERY=2)
+    def test_duplicate_vote_guard(self):
+        """重複投票の防止を有効にすると同じ投票者の2回目の投票が409で拒否され、フィルターがキャッシュから消えても保存分から復元されるアサート"""
+
+        self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        Question.objects.filter(pk=self.question.pk).update(prevent_duplicate_votes=True)
+
+        res = self.client.post(self.vote_url, {"choice": self.choice1.pk})
+        self.assertEqual(res.status_code, 302)
+        res = self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.assertEqual(res.status_code, 409)
+        self.assertContains(res, "You have already voted in this poll.", status_code=409)
+        # 存在しないセッションキーのCookieを送っても別の投票者にはならない
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = "unknown-session-key"
+        res = self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.assertEqual(res.status_code, 409)
+        del self.client.cookies[settings.SESSION_COOKIE_NAME]
+        # 別のIPアドレスの投票者は投票できる
+        res = self.client.post(self.vote_url, {"choice": self.choice2.pk}, REMOTE_ADDR="10.0.0.2")
+        self.assertEqual(res.status_code, 302)
+        self.choice1.refresh_from_db()
+        self.choice2.refresh_from_db()
+        self.assertEqual((self.choice1.votes, self.choice2.votes), (2, 1))
+
+        # 2人目の投票者で保存され、サイズは設定した投票者数で決まる
+        num_blocks, hashes = get_filter_params()
+        saved = VoteGuardFilter.objects.get(question_id=self.question.pk)
+        self.assertEqual((saved.num_blocks, saved.hashes), (num_blocks, hashes))
+        self.assertEqual(len(saved.bits), num_blocks * 64)
+        cache.clear()
+        res = self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.assertEqual(res.status_code, 409)
+        self.assertTrue(check_and_add(self.question.pk, "new voter"))
+        self.assertFalse(check_and_add(self.question.pk, "new voter"))
+
+        # キャッシュから消えたブロックを保存しても、保存済みの投票者は消えない
+        cache.clear()
+        save_filter(self.question.pk)
+        self.assertEqual(bytes(VoteGuardFilter.objects.get(question_id=self.question.pk).bits), bytes(saved.bits))
+        res = self.client.post(self.vote_url, {"choice": self.choice2.pk})
+        self.assertEqual(res.status_code, 409)
+
+    def test_import_votes_command(self):
+        """CSVとJSONLの投票データがChoiceごとに集計して加算され、不正な行と存在しないChoiceは飛ばされるアサート"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, "votes.csv")
+            with open(csv_path, "w") as f:
+                f.write(f"choice_id,votes\n{self.choice1.pk},\n{self.choice1.pk},3\n{self.choice2.pk},2\nx,1\n99999,5\n")
+            out = StringIO()
+            call_command("import_votes", csv_path, "--batch-size=1", stdout=out, stderr=StringIO())
+            self.assertIn("5 rows read, 6 votes imported, 1 invalid rows skipped, 1 unknown choices skipped.", out.getvalue())
+
+            jsonl_path = os.path.join(directory, "votes.jsonl")
+            with open(jsonl_path, "w") as f:
+                f.write(f'{{"choice_id": {self.choice2.pk}}}\n{{"choice_id": {self.choice2.pk}, "votes": 4}}\n{{broken\n')
+            call_command("import_votes", jsonl_path, stdout=StringIO())
+
+        self.choice1.refresh_from_db()
+        self.choice2.refresh_from_db()
+        self.assertEqual((self.choice1.votes, self.choice2.votes), (4, 7))
+
+
+class SQLiteWALTests(TestCase):
+    @override_settings(POLLS_SQLITE_WAL=True, POLLS_SQLITE_BUSY_TIMEOUT_MS=3000)
+    def test_sqlite_pragmas(self):
+        """新しい接続ごとにWALとbusy_timeoutが設定されるアサート"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            wrapper = DatabaseWrapper({**connection.settings_dict, "NAME": os.path.join(directory, "db.sqlite3")})
+            try:
+                with wrapper.cursor() as cursor:
+                    cursor.execute("PRAGMA journal_mode")
+                    self.assertEqual(cursor.fetchone()[0], "wal")
+                    cursor.execute("PRAGMA busy_timeout")
+                    self.assertEqual(cursor.fetchone()[0], 3000)
+            finally:
+                wrapper.close()
+
+    @override_settings(POLLS_SQLITE_WAL=True)
+    def test_serialized_write(self):
+        """書き込みは入れ子にでき、他のスレッドは先の書き込みが終わるまで待つアサート"""
+
+        order = []
+        started = threading.Event()
+
+        def write():
+            started.set()
+            with serialized_write():
+                order.append("thread")
+
+        with serialized_write():
+            with serialized_write():
+                thread = threading.Thread(target=write)
+                thread.start()
+                started.wait()
+                time.sleep(0.05)
+                order.append("main")
+        thread.join()
+        self.assertEqual(order, ["main", "thread"])
+
+
+@override_settings(POLLS_READ_REPLICAS=["replica"], POLLS_REPLICA_PIN_SECONDS=30)
+class ReplicaRouterTests(TestCase):
+    def test_router(self):
+        """匿名ユーザーのGETでのページとpollsのモデルの読み込みだけがレプリカに、それ以外はdefaultに振り分けられるアサート"""
+
+        router = PrimaryReplicaRouter()
+        self.assertEqual(router.db_for_write(Choice), "default")
+        self.assertFalse(router.allow_migrate("replica", "polls"))
+        self.assertIsNone(router.allow_migrate("default", "polls"))
+        # リクエストの外(管理コマンドやページツリーの操作など)ではプライマリから読み込む
+        self.assertEqual(router.db_for_read(Question), "default")
+
+        seen = []
+
+        def view(request):
+            seen.append((router.db_for_read(Question), router.db_for_read(Page), router.db_for_read(Session)))
+            return HttpResponse()
+
+        middleware = ReplicaPinMiddleware(view)
+        middleware(RequestFactory().get("/"))
+        pinned = RequestFactory().get("/")
+        pinned.COOKIES[PIN_COOKIE_NAME] = str(time.time() + 30)
+        middleware(pinned)
+        logged_in = RequestFactory().get("/")
+        logged_in.COOKIES[settings.SESSION_COOKIE_NAME] = "session"
+        middleware(logged_in)
+        middleware(RequestFactory().get("/admin/pages/"))
+        middleware(RequestFactory().post("/"))
+        self.assertEqual(seen[0], ("replica", "replica", "default"))
+        self.assertEqual(seen[1:], [("default", "default", "default")] * 4)
+        self.assertEqual(router.db_for_read(Question), "default")
+
+    def test_vote_pins_primary(self):
+        """投票したレスポンスでプライマリに固定するCookieが設定されるアサート"""
+
+        request = RequestFactory().post("/")
+        response = ReplicaPinMiddleware(lambda request: pin_to_primary(request) or HttpResponse())(request)
+        self.assertEqual(response.cookies[PIN_COOKIE_NAME]["max-age"], 30)
+        self.assertGreater(float(response.cookies[PIN_COOKIE_NAME].value), time.time())
+
+
+class VoteCacheCheckTests(SimpleTestCase):
+    def test_vote_cache_check(self):
+        """addとincrが不可分でないキャッシュはエラー、プロセスごとのキャッシュは本番でのみ警告になるアサート"""
+
+        self.assertEqual(check_vote_cache(None), [])
+        self.assertEqual([error.id for error in check_shared_cache(None)], ["polls.W001"])
+        file_cache = {"default": {"BACKEND": "django.core.cache.backends.filebased.FileBasedCache", "LOCATION": "/tmp"}}
+        with override_settings(CACHES=file_cache):
+            self.assertEqual([error.id for error in check_vote_cache(None)], ["polls.E001"])
+        redis_cache = {"default": {"BACKEND": "django.core.cache.backends.redis.RedisCache", "LOCATION": "redis://"}}
+        with override_settings(CACHES=redis_cache):
+            self.assertEqual(check_vote_cache(None) + check_shared_cache(None), [])
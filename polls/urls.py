@@ -0,0 +1,9 @@
+from django.urls import path  # type: ignore
+
+from . import views
+
+app_name = "polls"
+
+urlpatterns = [
+    path("<int:question_id>/vote/", views.vote, name="vote"),
+]
@@ -0,0 +1,90 @@
+from asgiref.sync import sync_to_async  # type: ignore
+from django.conf import settings  # type: ignore
+from django.http import (  # type: ignore
+    Http404,
+    HttpResponse,
+    HttpResponseForbidden,
+    HttpResponseNotAllowed,
+    HttpResponseRedirect,
+)
+from django.utils.crypto import constant_time_compare  # type: ignore
+from wagtail import hooks  # type: ignore
+
+from .metrics import registry, render_prometheus
+from .models import DUPLICATE_VOTE_MESSAGE, Choice, Question
+from .routers import pin_to_primary
+from .vote_guard import is_duplicate_vote
+from .votes import record_vote, vote_queue
+
+
+def render_vote_error(request, question, message="You didn't select a choice.", status=200):
+    """選択肢を選ばずに投票された場合などに詳細ページをエラー付きで表示する"""
+
+    response = question.render(
+        request,
+        template="polls/detail.html",
+        context_overrides={"error_message": message},
+    )
+    response.status_code = status
+    return response.render()
+
+
+def check_before_serve_page(request, question):
+    """Wagtailのserveと同じくbefore_serve_pageフックを実行し、閲覧制限などでフックが返したレスポンスを返す"""
+
+    for fn in hooks.get_hooks("before_serve_page"):
+        result = fn(question, request, [], {})
+        if isinstance(result, HttpResponse):
+            return result
+    return None
+
+
+def get_results_url(request, question):
+    return question.get_url(request) + question.reverse_subpage("results")
+
+
+async def vote(request, question_id):
+    """ASGI用の非同期の投票ビュー(Question.voteと同じ動作)
+
+    Wagtailのページ配信を経由しないので、閲覧制限(パスワード・ログイン)はbefore_serve_pageフックで確認する。
+    POLLS_ASYNC_VOTE_QUEUEがTrueの場合は書き込みをバックグラウンドのスレッドに任せて、すぐにリダイレクトする。
+    """
+
+    if request.method != "POST":
+        return HttpResponseNotAllowed(["POST"])
+    try:
+        question = await Question.objects.live().aget(pk=question_id)
+    except Question.DoesNotExist:
+        raise Http404 from None
+
+    response = await sync_to_async(check_before_serve_page)(request, question)
+    if response is not None:
+        return response
+
+    try:
+        choice = await Choice.objects.aget(pk=request.POST["choice"], question_id=question.pk)
+    except KeyError:
+        return await sync_to_async(render_vote_error)(request, question)
+
+    if await sync_to_async(is_duplicate_vote)(question, request):
+        return await sync_to_async(render_vote_error)(request, question, DUPLICATE_VOTE_MESSAGE, 409)
+
+    if getattr(settings, "POLLS_ASYNC_VOTE_QUEUE", False):
+        # 書き込みはレスポンスを返した後になるので、プライマリへの固定はここで行う
+        pin_to_primary(request)
+        vote_queue.put(choice, request)
+    else:
+        await sync_to_async(record_vote)(choice, request)
+    return HttpResponseRedirect(await sync_to_async(get_results_url)(request, question))
+
+
+def metrics(request):
+    """全てのワーカーのメトリクスをPrometheusのテキスト形式で返す
+
+    POLLS_METRICS_TOKENを設定した場合は「Authorization: Bearer <token>」ヘッダーが必要。
+    """
+
+    token = getattr(settings, "POLLS_METRICS_TOKEN", None)
+    if token and not constant_time_compare(request.headers.get("Authorization", ""), f"Bearer {token}"):
+        return HttpResponseForbidden()
+    return HttpResponse(render_prometheus(registry.collect()), content_type="text/plain; version=0.0.4; charset=utf-8")
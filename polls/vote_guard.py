@@ -0,0 +1,154 @@
+import contextlib
+import hashlib
+import math
+import time
+from typing import List, Tuple
+
+from django.conf import settings  # type: ignore
+from django.core.cache import cache  # type: ignore
+from django.db import transaction  # type: ignore
+from django.db.models import BinaryField  # type: ignore
+from django.db.models.functions import Substr  # type: ignore
+
+from . import models
+from .db import serialized_write
+from .votes import get_voter_hash
+
+# 1つの投票者のビットを全て同じブロック(64バイト)に置くブロック化したBloomフィルター。
+# 1回の確認はキャッシュのブロック1つの読み書きで済み、投票者が違えば別のブロックを更新することが多い
+BLOCK_BITS = 512
+BLOCK_BYTES = BLOCK_BITS // 8
+BLOCK_KEY = "polls:vote-guard:{question_id}:{num_blocks}x{hashes}:{block}"
+COUNT_KEY = "polls:vote-guard-count:{question_id}"
+# ブロックの読み込みから書き込みまでを1つずつ行うためのロック(持ったまま終了したプロセスの分は期限で外れる)
+LOCK_TIMEOUT = 2
+LOCK_POLL_INTERVAL = 0.005
+
+
+def get_filter_params() -> Tuple[int, int]:
+    """想定する投票者数と偽陽性率の設定から、ブロック数とハッシュ関数の数を求める"""
+
+    capacity = getattr(settings, "POLLS_VOTE_GUARD_CAPACITY", 100000)
+    error_rate = getattr(settings, "POLLS_VOTE_GUARD_ERROR_RATE", 0.001)
+    bits = -capacity * math.log(error_rate) / math.log(2) ** 2
+    num_blocks = max(1, math.ceil(bits / BLOCK_BITS))
+    hashes = max(1, round(num_blocks * BLOCK_BITS / capacity * math.log(2)))
+    return num_blocks, hashes
+
+
+def get_positions(voter_hash: str, num_blocks: int, hashes: int) -> Tuple[int, List[int]]:
+    """投票者のブロックの番号と、ブロック内のビットの位置のリスト"""
+
+    digest = hashlib.blake2b(voter_hash.encode(), digest_size=16).digest()
+    block = int.from_bytes(digest[:8], "big") % num_blocks
+    h1 = int.from_bytes(digest[8:12], "big")
+    h2 = int.from_bytes(digest[12:], "big") | 1
+    return block, [(h1 + i * h2) % BLOCK_BITS for i in range(hashes)]
+
+
+def _block_keys(question_id: int, num_blocks: int, hashes: int) -> List[str]:
+    return [
+        BLOCK_KEY.format(question_id=question_id, num_blocks=num_blocks, hashes=hashes, block=block)
+        for block in range(num_blocks)
+    ]
+
+
+def load_block(question_id: int, num_blocks: int, hashes: int, block: int) -> bytes:
+    """保存してあるフィルターから1つのブロックだけを読み込む(保存されていなければ空のブロック)"""
+
+    data = (
+        models.VoteGuardFilter.objects.filter(question_id=question_id, num_blocks=num_blocks, hashes=hashes)
+        .annotate(block_bits=Substr("bits", block * BLOCK_BYTES + 1, BLOCK_BYTES, output_field=BinaryField()))
+        .values_list("block_bits", flat=True)
+        .first()
+    )
+    return bytes(data) if data else bytes(BLOCK_BYTES)
+
+
+def save_filter(question_id: int):
+    """キャッシュにあるフィルターをデータベースに保存する(キャッシュから追い出されても復元できるように)
+
+    キャッシュから追い出されたブロックで保存済みのビットを消さないよう、保存してある内容との論理和を保存する。
+    """
+
+    num_blocks, hashes = get_filter_params()
+    keys = _block_keys(question_id, num_blocks, hashes)
+    cached = cache.get_many(keys)
+    with serialized_write(), transaction.atomic():
+        saved = models.VoteGuardFilter.objects.select_for_update().filter(question_id=question_id).first()
+        if saved is not None and (saved.num_blocks, saved.hashes) == (num_blocks, hashes):
+            bits = bytearray(saved.bits)
+        else:
+            bits = bytearray(num_blocks * BLOCK_BYTES)
+        for block, key in enumerate(keys):
+            if key not in cached:
+                continue
+            start = block * BLOCK_BYTES
+            bits[start : start + BLOCK_BYTES] = bytes(
+                a | b for a, b in zip(bits[start : start + BLOCK_BYTES], cached[key])
+            )
+        models.VoteGuardFilter.objects.update_or_create(
+            question_id=question_id, defaults={"num_blocks": num_blocks, "hashes": hashes, "bits": bytes(bits)}
+        )
+
+
+@contextlib.contextmanager
+def block_lock(key: str):
+    """キャッシュのaddでブロックのロックを取る。期限までに取れなければロックせずに続ける"""
+
+    lock_key = f"{key}:lock"
+    deadline = time.monotonic() + LOCK_TIMEOUT
+    acquired = cache.add(lock_key, 1, LOCK_TIMEOUT)
+    while not acquired and time.monotonic() < deadline:
+        time.sleep(LOCK_POLL_INTERVAL)
+        acquired = cache.add(lock_key, 1, LOCK_TIMEOUT)
+    try:
+        yield
+    finally:
+        if acquired:
+            cache.delete(lock_key)
+
+
+def check_and_add(question_id: int, voter_hash: str) -> bool:
+    """投票者をフィルターに追加する。既に投票している(と推定される)場合はFalseを返す
+
+    同時に同じブロックを更新してビットを失わないよう、ブロックのロックを取って読み込みから書き込みまでを行う。
+    ブロックがキャッシュに無ければ(追い出された場合を含む)保存してある内容から読み込む。
+    偽陽性により、初めての投票者をPOLLS_VOTE_GUARD_ERROR_RATEの確率で投票済みと判定する。
+    """
+
+    num_blocks, hashes = get_filter_params()
+    block, positions = get_positions(voter_hash, num_blocks, hashes)
+    key = BLOCK_KEY.format(question_id=question_id, num_blocks=num_blocks, hashes=hashes, block=block)
+    with block_lock(key):
+        data = cache.get(key)
+        if data is None:
+            data = load_block(question_id, num_blocks, hashes, block)
+        data = bytearray(data)
+        if all(data[position // 8] & (1 << position % 8) for position in positions):
+            return False
+        for position in positions:
+            data[position // 8] |= 1 << position % 8
+        cache.set(key, bytes(data), timeout=None)
+
+    # 一定の投票者数ごとにデータベースに保存する
+    count_key = COUNT_KEY.format(question_id=question_id)
+    cache.add(count_key, 0, timeout=None)
+    try:
+        count = cache.incr(count_key)
+    except ValueError:
+        count = 0
+    if count and count % getattr(settings, "POLLS_VOTE_GUARD_SAVE_EVERY", 100) == 0:
+        save_filter(question_id)
+    return True
+
+
+def is_duplicate_vote(question, request) -> bool:
+    """Questionで重複投票の防止が有効な場合に、同じ投票者(セッションまたはIPアドレス)の2回目以降の投票かどうか"""
+
+    if not question.prevent_duplicate_votes:
+        return False
+    voter_hash = get_voter_hash(request)
+    if not voter_hash:
+        return False
+    return not check_and_add(question.pk, voter_hash)
@@ -0,0 +1,430 @@
+import atexit
+import logging
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, Set
+
+from django.conf import settings  # type: ignore
+from django.core.cache import cache  # type: ignore
+from django.core.exceptions import ImproperlyConfigured  # type: ignore
+from django.db import IntegrityError, close_old_connections, transaction  # type: ignore
+from django.db.models import (  # type: ignore
+    Case,
+    Count,
+    Exists,
+    F,
+    IntegerField,
+    Max,
+    OuterRef,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Coalesce, Greatest  # type: ignore
+from django.utils import timezone  # type: ignore
+from django.utils.crypto import salted_hmac  # type: ignore
+
+from . import models
+from .checks import is_atomic_cache
+from .db import serialized_write
+from .routers import pin_to_primary
+from .signals import votes_changed
+
+logger = logging.getLogger(__name__)
+
+# キャッシュ上に溜める投票数の増分のキー
+VOTE_DELTA_KEY = "polls:vote-delta:{}"
+# 複数プロセスが同時にフラッシュしないためのロック
+VOTE_FLUSH_LOCK_KEY = "polls:vote-flush-lock"
+VOTE_FLUSH_LOCK_TIMEOUT = 30
+# 1回のUPDATEに含めるChoiceの最大数(CASE式が大きくなりすぎないように)
+UPDATE_BATCH_SIZE = 500
+
+
+def get_vote_mode():
+    """投票の書き込み方式を返す
+
+    "atomic"(既定)、"buffered"(write-behind)、"sharded"(分割カウンター)または"log"(投票ログへの追記)。
+    "buffered"の増分はキャッシュのincrで数えるので、incrが不可分でないキャッシュでは票を失わないよう使わせない。
+    """
+
+    mode = getattr(settings, "POLLS_VOTE_MODE", "atomic")
+    if mode == "buffered" and not is_atomic_cache():
+        message = 'POLLS_VOTE_MODE="buffered" requires a cache backend that increments atomically (Redis or Memcached).'
+        raise ImproperlyConfigured(message)
+    return mode
+
+
+def apply_vote_deltas(deltas: Dict[int, int]) -> int:
+    """Choiceのidと増分の辞書をまとめてvotesに加算する
+
+    読み込んでから保存するのではなく、F式による加算をデータベース側で行うので
+    同時に投票されても票が失われない。更新した行数を返す。
+    """
+
+    deltas = {choice_id: delta for choice_id, delta in deltas.items() if delta}
+    items = list(deltas.items())
+    updated = 0
+    for start in range(0, len(items), UPDATE_BATCH_SIZE):
+        batch = items[start : start + UPDATE_BATCH_SIZE]
+        if len(batch) == 1:
+            choice_id, delta = batch[0]
+            increment = Value(delta)
+        else:
+            increment = Case(
+                *[When(pk=choice_id, then=Value(delta)) for choice_id, delta in batch],
+                default=Value(0),
+                output_field=IntegerField(),
+            )
+        updated += models.Choice.objects.filter(pk__in=[choice_id for choice_id, _ in batch]).update(
+            votes=F("votes") + increment
+        )
+    return updated
+
+
+def leading_choice_subquery():
+    """Questionごとに票数(シャードを含む)が最も多いChoiceのidを返すサブクエリ(同数ならsort_orderが先のもの)"""
+
+    return Subquery(
+        annotate_vote_totals(models.Choice.objects.filter(question_id=OuterRef("pk")))
+        .order_by("-total_votes", "sort_order", "pk")
+        .values("pk")[:1]
+    )
+
+
+def update_question_totals(question_deltas: Dict[int, int]) -> int:
+    """Questionのtotal_votesに増分を加算し、leading_choiceとlast_vote_atを1回のUPDATEで更新する"""
+
+    question_deltas = {question_id: delta for question_id, delta in question_deltas.items() if delta}
+    if not question_deltas:
+        return 0
+    if len(question_deltas) == 1:
+        increment = Value(next(iter(question_deltas.values())))
+    else:
+        increment = Case(
+            *[When(pk=question_id, then=Value(delta)) for question_id, delta in question_deltas.items()],
+            default=Value(0),
+            output_field=IntegerField(),
+        )
+    return models.Question.objects.filter(pk__in=list(question_deltas)).update(
+        total_votes=F("total_votes") + increment,
+        leading_choice=leading_choice_subquery(),
+        last_vote_at=timezone.now(),
+    )
+
+
+def recompute_question_totals(chunk_size: int = 1000, since=None) -> int:
+    """Questionのtotal_votesとleading_choiceをChoiceとシャードから計算し直し、更新した件数を返す
+
+    主キーの範囲ごとに1回のUPDATEで更新する。last_vote_atはシャードの最後の加算日時の方が新しければ進める。
+    "sharded"では投票ごとにQuestionを更新しないので、sinceを指定して定期的に実行し、
+    その日時以降に投票があったQuestionだけに集計値を反映する。
+    """
+
+    choice_votes = (
+        models.Choice.objects.filter(question_id=OuterRef("pk"))
+        .order_by()
+        .values("question_id")
+        .annotate(sum=Sum("votes"))
+    )
+    shard_votes = (
+        models.ChoiceVoteShard.objects.filter(choice__question_id=OuterRef("pk"))
+        .order_by()
+        .values("choice__question_id")
+        .annotate(sum=Sum("votes"), last=Max("updated_at"))
+    )
+    last_shard_vote = Subquery(shard_votes.values("last"))
+    questions = models.Question.objects.all()
+    if since is not None:
+        questions = questions.filter(
+            Exists(models.ChoiceVoteShard.objects.filter(choice__question_id=OuterRef("pk"), updated_at__gte=since))
+        )
+    updated = 0
+    last_pk = 0
+    while True:
+        pks = list(questions.filter(pk__gt=last_pk).order_by("pk").values_list("pk", flat=True)[:chunk_size])
+        if not pks:
+            return updated
+        with serialized_write(), transaction.atomic():
+            updated += models.Question.objects.filter(pk__in=pks).update(
+                total_votes=Coalesce(Subquery(choice_votes.values("sum")), 0)
+                + Coalesce(Subquery(shard_votes.values("sum")), 0),
+                leading_choice=leading_choice_subquery(),
+                # GreatestはどちらかがNULLだとNULLになるデータベースがあるので、NULLを相手の値で置き換える
+                last_vote_at=Greatest(
+                    Coalesce("last_vote_at", last_shard_vote), Coalesce(last_shard_vote, "last_vote_at")
+                ),
+            )
+        last_pk = pks[-1]
+
+
+def apply_question_deltas(choice_deltas: Dict[int, int]) -> Set[int]:
+    """Choiceの増分をQuestionごとにまとめてupdate_question_totalsで反映し、QuestionのidのSetを返す"""
+
+    question_deltas: Dict[int, int] = defaultdict(int)
+    choices = models.Choice.objects.filter(pk__in=list(choice_deltas)).values_list("pk", "question_id")
+    for choice_id, question_id in choices:
+        question_deltas[question_id] += choice_deltas[choice_id]
+    update_question_totals(question_deltas)
+    return set(question_deltas)
+
+
+def send_votes_changed(question_ids: Iterable[int]):
+    """票数が変わったQuestionについてvotes_changedシグナルを送信する"""
+
+    question_ids = set(question_ids)
+    if question_ids:
+        votes_changed.send(sender=models.Choice, question_ids=question_ids)
+
+
+def flush_vote_deltas(choice_ids: Iterable[int]) -> int:
+    """キャッシュに溜まった指定Choiceの増分をデータベースへ書き込む
+
+    他のプロセスがフラッシュ中でロックを取得できなかった場合は-1を返す。
+    それ以外は反映した票数の合計を返す。
+    """
+
+    keys = {VOTE_DELTA_KEY.format(choice_id): choice_id for choice_id in choice_ids}
+    if not keys:
+        return 0
+    if not cache.add(VOTE_FLUSH_LOCK_KEY, 1, VOTE_FLUSH_LOCK_TIMEOUT):
+        return -1
+    try:
+        deltas = {keys[key]: value for key, value in cache.get_many(list(keys)).items() if value}
+        with serialized_write(), transaction.atomic():
+            apply_vote_deltas(deltas)
+            question_ids = apply_question_deltas(deltas)
+        # データベースへの反映が成功した分だけキャッシュから差し引く
+        # (フラッシュ中に加算された票は次回に持ち越される)
+        for choice_id, delta in deltas.items():
+            try:
+                cache.decr(VOTE_DELTA_KEY.format(choice_id), delta)
+            except ValueError:
+                pass
+        send_votes_changed(question_ids)
+        return sum(deltas.values())
+    finally:
+        cache.delete(VOTE_FLUSH_LOCK_KEY)
+
+
+class VoteBuffer:
+    """投票数の増分をキャッシュバックエンドに溜め、一定票数または一定時間ごとにまとめて書き込む"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # このプロセスで増分を加えたChoiceのid
+        self._pending = set()
+        self._count = 0
+        self._last_flush = time.monotonic()
+
+    def add(self, choice_id: int):
+        key = VOTE_DELTA_KEY.format(choice_id)
+        cache.add(key, 0, timeout=None)
+        try:
+            cache.incr(key)
+        except ValueError:  # add直後にキーが追い出された場合
+            cache.set(key, 1, timeout=None)
+
+        max_votes = getattr(settings, "POLLS_VOTE_BUFFER_MAX_VOTES", 100)
+        interval = getattr(settings, "POLLS_VOTE_BUFFER_INTERVAL_MS", 1000) / 1000
+        with self._lock:
+            self._pending.add(choice_id)
+            self._count += 1
+            due = self._count >= max_votes or time.monotonic() - self._last_flush >= interval
+        if due:
+            self.flush()
+
+    def flush_if_due(self) -> int:
+        """このプロセスで溜めた増分があり、前回の書き込みから間隔が過ぎていれば書き込む
+
+        投票が途絶えても、次のリクエストの終了時に溜まった増分が書き込まれる。
+        """
+
+        interval = getattr(settings, "POLLS_VOTE_BUFFER_INTERVAL_MS", 1000) / 1000
+        with self._lock:
+            due = self._pending and time.monotonic() - self._last_flush >= interval
+        if not due:
+            return 0
+        return self.flush()
+
+    def flush(self) -> int:
+        with self._lock:
+            choice_ids, self._pending = self._pending, set()
+            self._count = 0
+            self._last_flush = time.monotonic()
+        flushed = flush_vote_deltas(choice_ids)
+        if flushed < 0:
+            # 他のプロセスがフラッシュ中なので次回に持ち越す
+            with self._lock:
+                self._pending |= choice_ids
+        return flushed
+
+
+vote_buffer = VoteBuffer()
+
+
+def add_shard_vote(choice_id: int, shards=None):
+    """ランダムに選んだシャードに1票を加算する"""
+
+    if shards is None:
+        shards = getattr(settings, "POLLS_VOTE_SHARDS", 8)
+    shard = random.randrange(shards)  # noqa: S311
+    now = timezone.now()
+    rows = models.ChoiceVoteShard.objects.filter(choice_id=choice_id, shard=shard)
+    if rows.update(votes=F("votes") + 1, updated_at=now):
+        return
+    # シャードの行がまだ無ければ作成する(同時に作成された場合は加算し直す)
+    try:
+        with transaction.atomic():
+            models.ChoiceVoteShard.objects.create(choice_id=choice_id, shard=shard, votes=1, updated_at=now)
+    except IntegrityError:
+        rows.update(votes=F("votes") + 1, updated_at=now)
+
+
+def get_voter_hash(request) -> str:
+    """セッションキーまたはIPアドレスから投票者を識別するハッシュを作る(元の値は復元できない)
+
+    セッションキーはCookieの値なので、保存されているセッションのものだけを使う。
+    存在しないキーを毎回変えて送れば別の投票者になれてしまうので、その場合はIPアドレスで識別する。
+    """
+
+    session = getattr(request, "session", None)
+    identity = session.session_key if session is not None else None
+    if identity and not session.exists(identity):
+        identity = None
+    if not identity:
+        identity = request.META.get("REMOTE_ADDR", "")
+    if not identity:
+        return ""
+    return salted_hmac("polls.voter", identity, algorithm="sha256").hexdigest()
+
+
+def rollup_vote_events(batch_size: int = 10000, lag: float = 5) -> int:
+    """前回の集計位置より後のVoteEventをChoice.votesに集計し、集計した件数を返す
+
+    作成からlag秒経っていないイベントは、まだコミットされていない小さいidのイベントを
+    飛ばさないように次回に回す。
+    """
+
+    cutoff = timezone.now() - timezone.timedelta(seconds=lag)
+    total = 0
+    while True:
+        with serialized_write(), transaction.atomic():
+            mark, _ = models.VoteRollup.objects.select_for_update().get_or_create(pk=1)
+            events = models.VoteEvent.objects.filter(pk__gt=mark.last_event_id, created_at__lte=cutoff).order_by("pk")
+            # バッチの最後のidを上限にして、その範囲をChoiceごとに数える
+            upper = events.values_list("pk", flat=True)[batch_size - 1 : batch_size].first()
+            if upper is None:
+                upper = events.values_list("pk", flat=True).last()
+            if upper is None:
+                return total
+            counts = dict(
+                events.filter(pk__lte=upper)
+                .order_by()
+                .values("choice_id")
+                .annotate(count=Count("pk"))
+                .values_list("choice_id", "count")
+            )
+            apply_vote_deltas(counts)
+            question_ids = apply_question_deltas(counts)
+            mark.last_event_id = upper
+            mark.save()
+        send_votes_changed(question_ids)
+        total += sum(counts.values())
+
+
+def annotate_vote_totals(queryset):
+    """Choiceのクエリセットに、votesと全シャードを合計したtotal_votesを付ける"""
+
+    return queryset.annotate(total_votes=F("votes") + Coalesce(Sum("vote_shards__votes"), 0))
+
+
+def get_choice_totals(question):
+    """Questionの各Choiceをtotal_votes付きで返す"""
+
+    return annotate_vote_totals(models.Choice.objects.filter(question=question)).order_by("sort_order")
+
+
+def record_vote(choice: "models.Choice", request=None):
+    """1票を記録し、結果ページで自分の票が見えるようクライアントを一定時間プライマリに固定する"""
+
+    if request is not None:
+        pin_to_primary(request)
+    mode = get_vote_mode()
+    if mode == "log":
+        voter_hash = ""
+        if request is not None and getattr(settings, "POLLS_VOTE_LOG_VOTER_HASH", True):
+            voter_hash = get_voter_hash(request)
+        with serialized_write():
+            models.VoteEvent.objects.create(choice_id=choice.pk, voter_hash=voter_hash)
+    elif mode == "buffered":
+        vote_buffer.add(choice.pk)
+    elif mode == "sharded":
+        # 全ての投票が1つのQuestionの行を取り合わないように、集計値はrecompute_question_totalsでまとめて反映する
+        with serialized_write():
+            add_shard_vote(choice.pk)
+        send_votes_changed([choice.question_id])
+    else:
+        with serialized_write(), transaction.atomic():
+            apply_vote_deltas({choice.pk: 1})
+            update_question_totals({choice.question_id: 1})
+        send_votes_changed([choice.question_id])
+
+
+class VoteWriteQueue:
+    """投票の書き込みを1つのバックグラウンドスレッドで順番に行うキュー
+
+    非同期の投票ビューから使い、書き込みを待たずにレスポンスを返せるようにする。
+    """
+
+    def __init__(self, writer=None):
+        self._queue = queue.Queue()
+        self._writer = writer
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def put(self, choice: "models.Choice", request=None):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="polls-vote-writer", daemon=True)
+                self._thread.start()
+        self._queue.put((choice, request))
+
+    def _run(self):
+        writer = self._writer or record_vote
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                writer(*item)
+            except Exception:
+                logger.exception("Failed to record a vote")
+            finally:
+                self._queue.task_done()
+                if self._queue.empty():
+                    close_old_connections()
+
+    def pending(self) -> int:
+        """キューに入っていて、まだ書き込まれていない投票の数"""
+
+        return self._queue.unfinished_tasks
+
+    def join(self):
+        """キューに入っている投票が全て書き込まれるまで待つ"""
+
+        self._queue.join()
+
+    def stop(self, timeout: float = 5):
+        thread = self._thread
+        if thread is not None and thread.is_alive():
+            self._queue.put(None)
+            thread.join(timeout)
+
+
+vote_queue = VoteWriteQueue()
+atexit.register(vote_queue.stop)
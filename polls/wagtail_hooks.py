@@ -0,0 +1,35 @@
+from django.urls import path, reverse  # type: ignore
+from wagtail import hooks  # type: ignore
+from wagtail.admin import widgets as wagtailadmin_widgets  # type: ignore
+
+from . import admin_views
+from .models import Polls
+
+
+@hooks.register("register_admin_urls")
+def register_admin_urls():
+    return [
+        path("polls/<int:page_id>/export/", admin_views.export_results, name="polls_export_results"),
+    ]
+
+
+@hooks.register("before_serve_page")
+def set_metrics_route(page, request, serve_args, serve_kwargs):
+    """メトリクスのルート名を、ページの種類とルーティングされたサブページの名前にする(例: polls.question.vote)"""
+
+    route = page.specific_class._meta.label_lower if page.specific_class else "wagtailcore.page"
+    view = serve_args[0] if serve_args else None
+    if callable(view):
+        route = f"{route}.{view.__name__}"
+    request.metrics_route = route
+
+
+@hooks.register("register_page_listing_more_buttons")
+def page_listing_more_buttons(page, page_perms, next_url=None):
+    """Pollsページの「その他」メニューに投票結果のエクスポートを追加する"""
+
+    page_class = page.specific_class
+    if page_class is not None and issubclass(page_class, Polls) and page_perms.can_edit():
+        url = reverse("polls_export_results", args=[page.pk])
+        yield wagtailadmin_widgets.Button("Export results (CSV)", url, priority=60)
+        yield wagtailadmin_widgets.Button("Export results (JSONL)", f"{url}?format=jsonl", priority=61)
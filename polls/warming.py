@@ -0,0 +1,158 @@
+import io
+import logging
+import os
+from typing import Dict, Iterable, List
+from urllib.parse import urlsplit
+
+from django.apps import apps  # type: ignore
+from django.conf import settings  # type: ignore
+from django.core.handlers.base import BaseHandler  # type: ignore
+from django.core.handlers.wsgi import WSGIRequest  # type: ignore
+from django.template import TemplateDoesNotExist, TemplateSyntaxError, engines  # type: ignore
+from django.template.utils import get_app_template_dirs  # type: ignore
+from django.urls import get_resolver  # type: ignore
+from wagtail.models import Site  # type: ignore
+
+from .tallies import get_tally
+
+logger = logging.getLogger(__name__)
+
+
+def make_warm_request(url: str) -> WSGIRequest:
+    """匿名ユーザーのGETと同じリクエストを作る(Cookieを持たないのでページ全体のキャッシュの対象になる)"""
+
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == "https" else 80)
+    request = WSGIRequest(
+        {
+            "REQUEST_METHOD": "GET",
+            "PATH_INFO": parts.path or "/",
+            "SERVER_NAME": parts.hostname or "localhost",
+            "SERVER_PORT": str(port),
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "HTTP_HOST": parts.netloc or "localhost",
+            "REMOTE_ADDR": "127.0.0.1",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.errors": io.StringIO(),
+            "wsgi.url_scheme": parts.scheme or "http",
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": True,
+        }
+    )
+    request.is_dummy = True
+    return request
+
+
+def warm_urls(urls: Iterable[str]) -> Dict[str, int]:
+    """URLをミドルウェアを含めて1回ずつ処理し、レスポンスのステータスコードを返す
+
+    ページ全体のキャッシュ(POLLS_PAGE_CACHE_TIMEOUT)が有効ならHTMLがキャッシュされ、
+    無効でもテンプレートの読み込みとクエリの準備が済む。
+    """
+
+    handler = BaseHandler()
+    handler.load_middleware()
+    statuses = {}
+    for url in urls:
+        try:
+            response = handler.get_response(make_warm_request(url))
+            statuses[url] = response.status_code
+        except Exception:
+            logger.exception("Failed to warm %s", url)
+            statuses[url] = 500
+    return statuses
+
+
+def get_question_urls(question) -> List[str]:
+    """Questionの詳細ページと結果ページのURL"""
+
+    url = question.get_full_url()
+    if url is None:
+        return []
+    return [url, url + question.reverse_subpage("results")]
+
+
+def warm_questions(questions) -> Dict[str, int]:
+    """Questionの集計結果・詳細ページ・結果ページと、それを一覧に表示する親のPollsページのキャッシュを作る
+
+    親のPollsページは複数のQuestionで共有するので1回だけ処理する。
+    """
+
+    urls = []
+    parent_urls = []
+    for question in questions:
+        get_tally(question.pk)
+        urls.extend(get_question_urls(question))
+        parent_url = question.get_parent().get_full_url()
+        if parent_url is not None and parent_url not in parent_urls:
+            parent_urls.append(parent_url)
+    return warm_urls([*parent_urls, *urls])
+
+
+def get_project_template_names() -> List[str]:
+    """プロジェクト(BASE_DIR)内のテンプレートの名前。wagtailなどのインストールしたパッケージのテンプレートは含めない"""
+
+    names = []
+    # ローダーを明示してAPP_DIRSを無効にした場合(本番の設定)もアプリのtemplatesを含める
+    directories = {str(directory) for engine in engines.all() for directory in engine.template_dirs}
+    directories.update(str(directory) for directory in get_app_template_dirs("templates"))
+    for directory in sorted(directories):
+        if not directory.startswith(str(settings.BASE_DIR)):
+            continue
+        for root, _dirs, files in os.walk(directory):
+            for filename in files:
+                if filename.endswith((".html", ".txt")):
+                    name = os.path.relpath(os.path.join(root, filename), directory)
+                    if name not in names:
+                        names.append(name)
+    return sorted(names)
+
+
+def compile_templates() -> int:
+    """プロジェクトのテンプレートを読み込んでコンパイルする(キャッシュするローダーならプロセス内に残る)"""
+
+    compiled = 0
+    for name in get_project_template_names():
+        for engine in engines.all():
+            try:
+                engine.get_template(name)
+            except (TemplateDoesNotExist, TemplateSyntaxError):
+                logger.exception("Failed to compile template %s", name)
+                continue
+            compiled += 1
+            break
+    return compiled
+
+
+def get_route_urls(questions: int = 10) -> List[str]:
+    """サイトのルートと全てのPollsページ、最近公開したQuestionの詳細ページのURL"""
+
+    from .models import Polls, Question
+
+    urls = [site.root_url + "/" for site in Site.objects.all()]
+    for page in [*Polls.objects.live(), *Question.objects.live().order_by("-first_published_at")[:questions]]:
+        url = page.get_full_url()
+        if url is not None and url not in urls:
+            urls.append(url)
+    return urls
+
+
+def warm_up(questions: int = 10) -> Dict[str, int]:
+    """新しいプロセスが最初のリクエストから安定した応答時間で応答できるように準備する
+
+    全てのモデルとURLの設定を読み込み、テンプレートをコンパイルし、サイトのルートのパス(Site.get_site_root_paths)の
+    キャッシュを作ってから、主要なページを1回ずつ処理する。
+    """
+
+    # URLの設定から参照しているビューとwagtailのフックを全て読み込む
+    get_resolver().url_patterns  # noqa: B018
+    models = len(apps.get_models())
+    templates = compile_templates()
+    Site.get_site_root_paths()
+    statuses = warm_urls(get_route_urls(questions))
+    return {
+        "models": models,
+        "templates": templates,
+        "urls": sum(1 for status in statuses.values() if status < 400),
+        "failed_urls": sum(1 for status in statuses.values() if status >= 400),
+    }
@@ -0,0 +1,91 @@
+import atexit
+import logging
+import threading
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from wagtail.search.models import Query, QueryDailyHits
+from wagtail.search.utils import normalise_query_string
+
+from polls.db import serialized_write
+
+logger = logging.getLogger(__name__)
+
+
+class QueryHitBuffer:
+    """検索クエリのヒット数をメモリに溜めて、一定間隔でまとめてデータベースに書き込む
+
+    検索リクエストではデータベースに書き込まず、書き込みはバックグラウンドのスレッドで行う。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hits = Counter()
+        self._count = 0
+        self._last_flush = time.monotonic()
+        self._flushing = False
+
+    def add(self, query_string):
+        max_hits = getattr(settings, "SEARCH_HITS_FLUSH_MAX", 100)
+        interval = getattr(settings, "SEARCH_HITS_FLUSH_INTERVAL", 10)
+        with self._lock:
+            self._hits[(normalise_query_string(query_string), timezone.now().date())] += 1
+            self._count += 1
+            due = not self._flushing and (
+                self._count >= max_hits or time.monotonic() - self._last_flush >= interval
+            )
+            if due:
+                self._flushing = True
+        if due:
+            threading.Thread(target=self._flush_in_background, name="search-hits-writer", daemon=True).start()
+
+    def _flush_in_background(self):
+        try:
+            self.flush()
+        except Exception:
+            logger.exception("Failed to record search query hits")
+        finally:
+            close_old_connections()
+
+    def flush(self):
+        """溜まっているヒット数を書き込み、書き込んだヒット数の合計を返す"""
+
+        with self._lock:
+            hits, self._hits = self._hits, Counter()
+            self._count = 0
+            self._last_flush = time.monotonic()
+            if not hits:
+                self._flushing = False
+                return 0
+        try:
+            with serialized_write(), transaction.atomic():
+                for (query_string, date), count in hits.items():
+                    query = Query.get(query_string)
+                    daily_hits, _ = QueryDailyHits.objects.get_or_create(query=query, date=date)
+                    QueryDailyHits.objects.filter(pk=daily_hits.pk).update(hits=F("hits") + count)
+        except Exception:
+            # 書き込めなかったヒット数は次回に持ち越す
+            with self._lock:
+                self._hits.update(hits)
+            raise
+        finally:
+            with self._lock:
+                self._flushing = False
+        return sum(hits.values())
+
+
+hit_buffer = QueryHitBuffer()
+# 終了時に残っているヒット数を書き込む
+atexit.register(hit_buffer._flush_in_background)
+
+
+def record_hit(query_string):
+    """検索クエリのヒットを記録する(SEARCH_RECORD_HITSがFalseなら何もしない)"""
+
+    if getattr(settings, "SEARCH_RECORD_HITS", True):
+        hit_buffer.add(query_string)
@@ -0,0 +1,77 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from wagtail.models import Page
+from wagtail.search.utils import normalise_query_string
+
+from polls.metrics import record_cache
+
+RESULTS_CACHE_KEY = "search:results:{}:{}:{}"
+
+
+class CountlessPage:
+    """全体の件数を数えずに、次のページの有無だけを持つページ
+
+    テンプレートからはPaginatorのページと同じように使える。
+    """
+
+    def __init__(self, object_list, number, has_next):
+        self.object_list = object_list
+        self.number = number
+        self._has_next = has_next
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self.number > 1
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+
+def paginate_search(search_query, page_number, per_page=10):
+    """検索結果の1ページ分をCOUNTを使わずに取得する
+
+    page_size + 1件を取得して次のページの有無を判定し、ページのidのリストを短時間キャッシュする。
+    キャッシュがあれば検索バックエンドは使わずに、idからページを取得する。
+    """
+
+    try:
+        number = max(int(page_number), 1)
+    except (TypeError, ValueError):
+        number = 1
+
+    normalised = normalise_query_string(search_query)
+    key = RESULTS_CACHE_KEY.format(
+        hashlib.md5(normalised.encode()).hexdigest(), per_page, number  # noqa: S324
+    )
+    cached = cache.get(key)
+    record_cache("search_results", cached is not None)
+    if cached is not None:
+        ids, has_next = cached
+        pages = Page.objects.live().in_bulk(ids)
+        return CountlessPage([pages[pk] for pk in ids if pk in pages], number, has_next)
+
+    offset = (number - 1) * per_page
+    window = list(Page.objects.live().search(normalised)[offset : offset + per_page + 1])
+    object_list, has_next = window[:per_page], len(window) > per_page
+    cache.set(key, ([page.pk for page in object_list], has_next), getattr(settings, "SEARCH_RESULTS_CACHE_TIMEOUT", 30))
+    return CountlessPage(object_list, number, has_next)
@@ -0,0 +1,63 @@
+from unittest.mock import patch
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from wagtail.models import Page
+from wagtail.search.models import Query
+
+from .hits import hit_buffer
+
+
+@override_settings(SEARCH_HITS_FLUSH_MAX=1000, SEARCH_HITS_FLUSH_INTERVAL=3600)
+class SearchHitTests(TestCase):
+    def test_buffered_hits(self):
+        """検索時にはヒット数を書き込まず、まとめて書き込むアサート"""
+
+        self.client.get("/search/", {"query": "Polls"})
+        self.client.get("/search/", {"query": " polls "})
+        self.assertFalse(Query.objects.exists())
+
+        self.assertEqual(hit_buffer.flush(), 2)
+        self.assertEqual(Query.get("polls").hits, 2)
+
+    @override_settings(SEARCH_RECORD_HITS=False)
+    def test_disable_hits(self):
+        """SEARCH_RECORD_HITSがFalseの場合はヒット数を記録しないアサート"""
+
+        self.client.get("/search/", {"query": "polls"})
+        self.assertEqual(hit_buffer.flush(), 0)
+
+
+@override_settings(SEARCH_COUNTLESS_PAGINATION=True, SEARCH_RECORD_HITS=False)
+class CountlessPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        home = Page.objects.get(depth=2)
+        for i in range(12):
+            home.add_child(instance=Page(title=f"Polls {i}", slug=f"polls-{i}"))
+
+    def setUp(self):
+        cache.clear()
+
+    def test_countless_pagination(self):
+        """件数を数えずに次のページの有無を判定し、2回目は検索結果のidのキャッシュを使うアサート"""
+
+        with CaptureQueriesContext(connection) as queries:
+            res = self.client.get("/search/", {"query": "polls"})
+        self.assertFalse([query for query in queries if "COUNT(" in query["sql"].upper()])
+        self.assertEqual(len(res.context["search_results"]), 10)
+        self.assertTrue(res.context["search_results"].has_next())
+        self.assertContains(res, "page=2")
+
+        res = self.client.get("/search/", {"query": "polls", "page": 2})
+        self.assertEqual(len(res.context["search_results"]), 2)
+        self.assertFalse(res.context["search_results"].has_next())
+        self.assertTrue(res.context["search_results"].has_previous())
+
+        with patch("wagtail.query.PageQuerySet.search") as search:
+            res = self.client.get("/search/", {"query": " Polls "})
+        search.assert_not_called()
+        self.assertEqual(len(res.context["search_results"]), 10)
@@ -1,21 +1,35 @@
+from django.conf import settings
 from django.core.paginator import EmptyPage, PageNotAnInteger, Paginator
 from django.template.response import TemplateResponse
 
 from wagtail.models import Page
-from wagtail.search.models import Query
+
+from .hits import record_hit
+from .pagination import paginate_search
 
 
 def search(request):
     search_query = request.GET.get("query", None)
     page = request.GET.get("page", 1)
 
+    # Count-free pagination with cached result ids
+    if search_query and getattr(settings, "SEARCH_COUNTLESS_PAGINATION", False):
+        record_hit(search_query)
+        return TemplateResponse(
+            request,
+            "search/search.html",
+            {
+                "search_query": search_query,
+                "search_results": paginate_search(search_query, page),
+            },
+        )
+
     # Search
     if search_query:
         search_results = Page.objects.live().search(search_query)
-        query = Query.get(search_query)
 
-        # Record hit
-        query.add_hit()
+        # Record hit (buffered and written in batches)
+        record_hit(search_query)
     else:
         search_results = Page.objects.none()
 